@@ -0,0 +1,176 @@
+"""
+Template Allocation Matrix
+Compiles allocation templates into a sparse assets x template-line matrix so a
+whole snapshot is split across alloc / secind / inter lines in one NumPy pass
+"""
+
+import math
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+# Template line families; each family of a template splits the full position amount
+FAMILIES = ('alloc', 'secind', 'inter')
+
+
+def _int_code(value) -> int:
+    """Template codes are stored as strings; NULL means code 0"""
+    return int('0' if value is None else value)
+
+
+def template_lines(template_details: List[Dict]) -> List[Tuple[int, Tuple[str, int, int], float, float]]:
+    """
+    Compile template details into allocation lines
+
+    Args:
+        template_details: Rows with tcode, tval1, tval2, prct
+
+    Returns:
+        List of (detail index, (tcode, code1, code2), weight, family weight) tuples for
+        the alloc/secind/inter lines, where family weight is the sum of weights of
+        all lines in the same family
+    """
+    lines = []
+    family_totals = {}
+    for i, detail in enumerate(template_details):
+        tcode = detail['tcode'].lower()
+        if tcode not in FAMILIES:
+            continue
+        code2 = _int_code(detail['tval2']) if tcode == 'secind' else 0
+        weight = float(detail['prct']) / 100
+        lines.append((i, (tcode, _int_code(detail['tval1']), code2), weight))
+        family_totals[tcode] = family_totals.get(tcode, 0.0) + weight
+
+    return [(i, key, weight, family_totals[key[0]]) for i, key, weight in lines]
+
+
+def split_amount(amount: float, template_details: List[Dict]) -> List[float]:
+    """
+    Split one position across its template lines using largest-remainder rounding
+
+    Each family's line amounts add up exactly (to the cent) to the position amount
+    scaled by the family's total percentage. Produces the same amounts as
+    AllocationMatrix.split for the same template.
+
+    Args:
+        amount: Position amount
+        template_details: Rows with tcode, tval1, tval2, prct
+
+    Returns:
+        Amount per template detail row (0.0 for rows outside alloc/secind/inter)
+    """
+    result = [0.0] * len(template_details)
+    cents = round(amount * 100)
+    sign = -1 if cents < 0 else 1
+    cents = abs(cents)
+
+    groups = {}
+    for i, key, weight, family_weight in template_lines(template_details):
+        exact = cents * weight
+        floor = math.floor(exact + 1e-6)
+        groups.setdefault(key[0], []).append([i, floor, exact - floor, family_weight])
+
+    for members in groups.values():
+        target = round(cents * members[0][3])
+        remainder = int(target - sum(member[1] for member in members))
+        # Largest fractional parts get the leftover cents; ties go to the earlier line
+        order = sorted(range(len(members)), key=lambda k: -members[k][2])
+        for rank, k in enumerate(order):
+            if rank < remainder:
+                members[k][1] += 1
+        for i, floor, _, _ in members:
+            result[i] = sign * floor / 100
+
+    return result
+
+
+class AllocationMatrix:
+    """
+    Sparse assets x (alloc code / sector-industry / interest code) matrix
+
+    Stored in CSR form: the lines of asset row r are indptr[r]:indptr[r + 1] and
+    each line has a column (template key), a weight and its family weight.
+    """
+
+    def __init__(self, details_by_asset: Dict[int, List[Dict]]):
+        self.columns = []  # (tcode, code1, code2) per column
+        column_index = {}
+        self.asset_row = {}
+
+        indptr = [0]
+        line_columns = []
+        line_weights = []
+        line_family = []
+        line_family_weights = []
+
+        for asset_id, details in details_by_asset.items():
+            for _, key, weight, family_weight in template_lines(details):
+                if key not in column_index:
+                    column_index[key] = len(self.columns)
+                    self.columns.append(key)
+                line_columns.append(column_index[key])
+                line_weights.append(weight)
+                line_family.append(FAMILIES.index(key[0]))
+                line_family_weights.append(family_weight)
+            self.asset_row[asset_id] = len(indptr) - 1
+            indptr.append(len(line_columns))
+
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.line_columns = np.array(line_columns, dtype=np.int64)
+        self.line_weights = np.array(line_weights, dtype=np.float64)
+        self.line_family = np.array(line_family, dtype=np.int64)
+        self.line_family_weights = np.array(line_family_weights, dtype=np.float64)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.asset_row), len(self.columns)
+
+    def split(self, asset_ids, amounts) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Split every position across its template lines in one vectorized pass
+
+        Args:
+            asset_ids: Asset id per position
+            amounts: Amount per position
+
+        Returns:
+            (position index, column index, amount) arrays with one entry per line,
+            ordered by position and then by template line order
+        """
+        rows = np.array([self.asset_row[asset_id] for asset_id in asset_ids], dtype=np.int64)
+        cents = np.rint(np.asarray(amounts, dtype=np.float64) * 100)
+        signs = np.where(cents < 0, -1.0, 1.0)
+        cents = np.abs(cents)
+
+        # Expand each position into its CSR line range
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        positions = np.repeat(np.arange(len(rows)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        lines = np.repeat(starts, counts) + offsets
+
+        exact = cents[positions] * self.line_weights[lines]
+        floors = np.floor(exact + 1e-6)
+        fractions = exact - floors
+
+        # Largest remainder within each (position, family) group
+        groups = positions * len(FAMILIES) + self.line_family[lines]
+        order = np.lexsort((np.arange(len(lines)), -fractions, groups))
+        sorted_groups = groups[order]
+        group_start = np.searchsorted(sorted_groups, sorted_groups, side='left')
+        rank = np.empty(len(lines), dtype=np.int64)
+        rank[order] = np.arange(len(lines)) - group_start
+
+        targets = np.rint(cents[positions] * self.line_family_weights[lines])
+        floor_totals = np.zeros(len(rows) * len(FAMILIES))
+        np.add.at(floor_totals, groups, floors)
+        remainders = targets - floor_totals[groups]
+        floors += rank < remainders
+
+        return positions, self.line_columns[lines], signs[positions] * floors / 100
+
+    def totals(self, asset_ids, amounts) -> np.ndarray:
+        """Snapshot totals per column (the matrix product of positions and weights)"""
+        _, columns, line_amounts = self.split(asset_ids, amounts)
+        return np.bincount(columns, weights=line_amounts, minlength=len(self.columns))
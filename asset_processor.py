@@ -6,18 +6,27 @@ Processes Asset.xls and manages MySQL database operations
 
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import PoolError
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Tuple
-import requests
-from bs4 import BeautifulSoup
-import csv
-from io import StringIO
+from typing import Callable, Optional, List, Dict, Tuple
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from allocation_matrix import AllocationMatrix, split_amount
+from gains_matrix import HORIZONS, horizon_returns, lookback_gains
+from price_cache import PriceCache
+from price_providers import MorningstarProvider, PriceFetcher, PriceProvider, ProviderChain, YahooProvider
+from trading_calendar import TradingCalendar
 
 
 class AssetDatabase:
     """Handles all database operations for asset management"""
     
-    def __init__(self, host='localhost', port=3306, user='root', password='sa123', database='asset'):
+    def __init__(self, host='localhost', port=3306, user='root', password='sa123', database='asset',
+                 pool_size: int = 4, max_idle_seconds: float = 300):
         self.host = host
         self.port = port
         self.user = user
@@ -25,37 +34,143 @@ class AssetDatabase:
         self.database = database
         self.connection = None
         self.cursor = None
+        
+        # Bounded connection pool shared by every component holding this object
+        self.pool_size = pool_size
+        self.max_idle_seconds = max_idle_seconds
+        self.connections_opened = 0  # Physical connections opened this run
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._checked_out = 0
+        self._session_depth = 0
+        self._pool_lock = threading.Condition()
+    
+    def _connect(self):
+        """Open a new physical MySQL connection"""
+        connection = mysql.connector.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            autocommit=False
+        )
+        self.connections_opened += 1
+        print(f"Connected to MySQL database: {self.database}")
+        return connection
+    
+    @staticmethod
+    def _discard(connection):
+        """Close a pooled connection, ignoring errors from dead sockets"""
+        try:
+            connection.close()
+        except Error:
+            pass
+    
+    def _evict_idle(self, now: float):
+        """Close idle connections that exceeded max_idle_seconds"""
+        fresh = []
+        for connection, last_used in self._idle:
+            if now - last_used > self.max_idle_seconds:
+                self._discard(connection)
+            else:
+                fresh.append((connection, last_used))
+        self._idle = fresh
+    
+    def checkout(self, timeout: float = 30):
+        """Borrow a healthy connection from the pool, opening a new one if allowed"""
+        deadline = time.monotonic() + timeout
+        with self._pool_lock:
+            while True:
+                now = time.monotonic()
+                self._evict_idle(now)
+                while self._idle:
+                    connection, _ = self._idle.pop()
+                    # Health check on borrow (is_connected pings the server)
+                    if connection.is_connected():
+                        self._checked_out += 1
+                        return connection
+                    self._discard(connection)
+                
+                if self._checked_out < self.pool_size:
+                    # Reserve the slot before connecting outside the lock
+                    self._checked_out += 1
+                    break
+                
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolError(f"No MySQL connection available (pool size {self.pool_size})")
+                self._pool_lock.wait(remaining)
+        
+        try:
+            return self._connect()
+        except Error:
+            with self._pool_lock:
+                self._checked_out -= 1
+                self._pool_lock.notify()
+            raise
+    
+    def checkin(self, connection):
+        """Return a borrowed connection to the pool"""
+        try:
+            # Discard any uncommitted work, as closing the connection used to
+            connection.rollback()
+            healthy = True
+        except Error:
+            healthy = False
+        
+        with self._pool_lock:
+            self._checked_out -= 1
+            if healthy:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._discard(connection)
+            self._pool_lock.notify()
     
     def open_db(self):
-        """Open database connection"""
+        """Check out a pooled connection for this session (re-entrant)"""
         try:
-            if self.connection is None or not self.connection.is_connected():
-                self.connection = mysql.connector.connect(
-                    host=self.host,
-                    port=self.port,
-                    user=self.user,
-                    password=self.password,
-                    database=self.database,
-                    autocommit=False
-                )
+            if self._session_depth == 0 or self.connection is None:
+                self.connection = self.checkout()
                 self.cursor = self.connection.cursor(dictionary=True)
-                print(f"Connected to MySQL database: {self.database}")
+            self._session_depth += 1
         except Error as e:
             print(f"Error connecting to MySQL: {e}")
             raise
     
     def close_db(self):
-        """Close database connection"""
+        """Return the session connection to the pool once the outermost caller is done"""
+        if self._session_depth > 0:
+            self._session_depth -= 1
+        if self._session_depth > 0:
+            return
+        
         try:
             if self.cursor:
                 self.cursor.close()
-            if self.connection and self.connection.is_connected():
-                self.connection.close()
-                print("MySQL connection closed")
-            self.connection = None
-            self.cursor = None
+            if self.connection:
+                self.checkin(self.connection)
         except Error as e:
             print(f"Error closing MySQL connection: {e}")
+        finally:
+            self.connection = None
+            self.cursor = None
+    
+    @contextmanager
+    def session(self):
+        """Hold a pooled connection for the duration of a with-block"""
+        self.open_db()
+        try:
+            yield self
+        finally:
+            self.close_db()
+    
+    def close_all(self):
+        """Close all idle pooled connections and report connection usage for the run"""
+        with self._pool_lock:
+            for connection, _ in self._idle:
+                self._discard(connection)
+            self._idle = []
+        print(f"MySQL connections opened this run: {self.connections_opened}")
     
     def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
         """Execute a SELECT query and return results"""
@@ -67,15 +182,30 @@ class AssetDatabase:
             print(f"Query: {query}")
             raise
     
-    def execute_update(self, query: str, params: tuple = None):
-        """Execute an INSERT/UPDATE/DELETE query"""
+    def execute_update(self, query: str, params: tuple = None) -> int:
+        """Execute an INSERT/UPDATE/DELETE query and return the affected row count"""
         try:
             self.cursor.execute(query, params)
+            return self.cursor.rowcount
         except Error as e:
             print(f"Error executing update: {e}")
             print(f"Query: {query}")
             raise
     
+    def execute_many(self, query: str, rows: List[tuple], batch_size: int = 500) -> int:
+        """Execute an INSERT/UPDATE for many parameter rows in batches, returning rows affected"""
+        affected = 0
+        try:
+            for start in range(0, len(rows), batch_size):
+                # executemany rewrites INSERT ... VALUES into one multi-row statement
+                self.cursor.executemany(query, rows[start:start + batch_size])
+                affected += self.cursor.rowcount
+        except Error as e:
+            print(f"Error executing batch: {e}")
+            print(f"Query: {query}")
+            raise
+        return affected
+    
     def begin_transaction(self):
         """Begin a database transaction"""
         self.connection.start_transaction()
@@ -96,11 +226,311 @@ class AssetDatabase:
             print(f"Error rolling back transaction: {e}")
 
 
+# Broker tickers that are stored under a different ticker in the asset table
+TICKER_ALIASES = {
+    'VMRXX': 'VMMXX',
+}
+
+
+class AssetIndex:
+    """In-memory ticker/asset name to assetid index built from a single scan of the asset table"""
+    
+    def __init__(self, aliases: Optional[Dict[str, str]] = None):
+        self.aliases = dict(TICKER_ALIASES if aliases is None else aliases)
+        self.unresolved = []  # [{'ticker', 'held_at', 'row'}] for lookups that missed
+        self._ids = {}
+    
+    @staticmethod
+    def _key(name) -> str:
+        """Normalize a key the way MySQL's case-insensitive, space-padded collation compares it"""
+        return str(name).rstrip().casefold()
+    
+    def load(self, db: AssetDatabase) -> 'AssetIndex':
+        """Load tickers and asset names; the lowest assetid wins when a name is ambiguous"""
+        with db.session():
+            rows = db.execute_query("SELECT assetid, ticker, assetname FROM asset ORDER BY assetid")
+        
+        self._ids = {}
+        for row in rows:
+            for name in (row['ticker'], row['assetname']):
+                if name is not None and str(name).strip():
+                    self._ids.setdefault(self._key(name), row['assetid'])
+        
+        print(f"Loaded asset index: {len(rows)} assets, {len(self._ids)} lookup keys")
+        return self
+    
+    def canonical_ticker(self, ticker: str) -> str:
+        """Apply alias mapping (e.g. VMRXX -> VMMXX)"""
+        return self.aliases.get(ticker, ticker)
+    
+    def resolve(self, ticker: str, held_at: str = '', row=None) -> Optional[int]:
+        """Return the assetid matching a ticker or asset name, recording misses in unresolved"""
+        asset_id = self._ids.get(self._key(self.canonical_ticker(ticker)))
+        if asset_id is None:
+            self.unresolved.append({'ticker': ticker, 'held_at': held_at, 'row': row})
+        return asset_id
+
+
+class TemplateCache:
+    """Caches templatedetails grouped by templateid and maps each asset to its template"""
+    
+    def __init__(self, db: AssetDatabase):
+        self.db = db
+        self._details_by_template = None
+        self._template_by_asset = None
+        self._matrix = None
+    
+    def load(self):
+        """Load all template details and asset templates in one pass"""
+        with self.db.session():
+            details = self.db.execute_query(
+                "SELECT templateid, tcode, tval1, tval2, prct FROM templatedetails"
+            )
+            assets = self.db.execute_query("SELECT assetid, templateid FROM asset")
+        
+        details_by_template = {}
+        for row in details:
+            details_by_template.setdefault(row['templateid'], []).append({
+                'tcode': row['tcode'],
+                'tval1': row['tval1'],
+                'tval2': row['tval2'],
+                'prct': row['prct'],
+            })
+        
+        self._details_by_template = details_by_template
+        self._template_by_asset = {row['assetid']: row['templateid'] for row in assets}
+        print(f"Loaded {len(details)} template details for {len(details_by_template)} templates")
+    
+    def invalidate(self):
+        """Drop cached templates so the next lookup reloads them"""
+        self._details_by_template = None
+        self._template_by_asset = None
+        self._matrix = None
+    
+    def details_for_asset(self, asset_id: int) -> List[Dict]:
+        """Return the template details (tcode, tval1, tval2, prct) for an asset"""
+        if self._details_by_template is None:
+            self.load()
+        template_id = self._template_by_asset.get(asset_id)
+        return self._details_by_template.get(template_id, [])
+    
+    def matrix(self) -> AllocationMatrix:
+        """Return the allocation matrix compiled from the cached templates"""
+        if self._details_by_template is None:
+            self.load()
+        if self._matrix is None:
+            self._matrix = AllocationMatrix({
+                asset_id: self._details_by_template.get(template_id, [])
+                for asset_id, template_id in self._template_by_asset.items()
+            })
+        return self._matrix
+
+
+# Staging copies of the holdings tables used to load a date before publishing it
+STAGING_TABLES = {
+    'assetinv': 'assetinv_stage',
+    'assetinvalloc': 'assetinvalloc_stage',
+    'assetinvsecind': 'assetinvsecind_stage',
+    'assetinvinter': 'assetinvinter_stage',
+}
+
+
+class IdBlockAllocator:
+    """Hands out assetinvid values from blocks reserved up front in the idsequence table"""
+    
+    def __init__(self, db: AssetDatabase, name: str = 'assetinv', table: str = 'assetinv',
+                 column: str = 'assetinvid', block_size: int = 1000):
+        self.db = db
+        self.name = name
+        self.table = table
+        self.column = column
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0  # Exclusive end of the current block
+    
+    def _reserve(self, count: int):
+        """Reserve count ids on a separate pooled connection so the block commits on its own"""
+        connection = self.db.checkout()
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS idsequence "
+                "(name VARCHAR(64) NOT NULL PRIMARY KEY, nextid BIGINT NOT NULL)"
+            )
+            connection.start_transaction()
+            cursor.execute("INSERT IGNORE INTO idsequence(name, nextid) VALUES (%s, 1)", (self.name,))
+            # Row lock serializes concurrent runs reserving from the same sequence
+            cursor.execute("SELECT nextid FROM idsequence WHERE name=%s FOR UPDATE", (self.name,))
+            next_id = cursor.fetchone()['nextid']
+            # Stay ahead of rows inserted without the sequence (e.g. by older versions or by hand)
+            cursor.execute(f"SELECT COALESCE(MAX({self.column}), 0) + 1 AS floor_id FROM {self.table}")
+            start = max(int(next_id), int(cursor.fetchone()['floor_id']))
+            cursor.execute("UPDATE idsequence SET nextid=%s WHERE name=%s", (start + count, self.name))
+            connection.commit()
+            cursor.close()
+        except Error as e:
+            connection.rollback()
+            print(f"Error reserving {self.name} ids: {e}")
+            raise
+        finally:
+            self.db.checkin(connection)
+        
+        self._next = start
+        self._end = start + count
+    
+    def next_id(self) -> int:
+        """Return the next id, reserving a new block when the current one is used up"""
+        if self._next >= self._end:
+            self._reserve(self.block_size)
+        assetinv_id = self._next
+        self._next += 1
+        return assetinv_id
+
+
+class AllocationBatch:
+    """Collects assetinv and child allocation rows for one as-of date in memory.
+    
+    Mirrors allocate_asset_ref row for row: a repeated (assetid, heldat) adds to
+    the existing position and its child rows instead of inserting new ones.
+    """
+    
+    INSERTS = {
+        'assetinv': "INSERT INTO {table}(assetinvid, assetid, asofdate, amount, heldat) VALUES (%s, %s, %s, %s, %s)",
+        'assetinvalloc': "INSERT INTO {table}(assetinvid, alloccode, amount) VALUES (%s, %s, %s)",
+        'assetinvsecind': "INSERT INTO {table}(assetinvid, sec_id, ind_id, amount) VALUES (%s, %s, %s, %s)",
+        'assetinvinter': "INSERT INTO {table}(assetinvid, intercode, amount) VALUES (%s, %s, %s)",
+    }
+    
+    UPDATES = {
+        'assetinv': "UPDATE {table} SET amount = amount + %s WHERE assetinvid = %s",
+        'assetinvalloc': "UPDATE {table} SET amount = amount + %s WHERE assetinvid = %s AND alloccode = %s",
+        'assetinvsecind': "UPDATE {table} SET amount = amount + %s WHERE assetinvid = %s AND sec_id = %s AND ind_id = %s",
+        'assetinvinter': "UPDATE {table} SET amount = amount + %s WHERE assetinvid = %s AND intercode = %s",
+    }
+    
+    CHILD_TABLES = {'alloc': 'assetinvalloc', 'secind': 'assetinvsecind', 'inter': 'assetinvinter'}
+    
+    # Key columns of each child table after assetinvid (amount follows)
+    CHILD_COLUMNS = {
+        'assetinvalloc': ('alloccode',),
+        'assetinvsecind': ('sec_id', 'ind_id'),
+        'assetinvinter': ('intercode',),
+    }
+    
+    def __init__(self, date_str: str, next_id: Callable[[], int], existing: List[Dict], batch_size: int = 500,
+                 tables: Optional[Dict[str, str]] = None):
+        self.date_str = date_str
+        self.next_id = next_id
+        self.batch_size = batch_size
+        self.tables = tables  # Target table names (e.g. STAGING_TABLES); None writes the live tables
+        self.diff = False  # Apply as a diff against stored rows instead of inserting
+        self.held_at_totals = {}  # Amount written per heldat, for validating what was written
+        
+        # (assetid, heldat) -> [assetinvid, amount, staged assetinv row or None if already stored]
+        self.positions = {}
+        for row in existing:
+            key = (row['assetid'], row['heldat'])
+            self.positions.setdefault(key, [row['assetinvid'], float(row['amount']), None])
+        
+        # (assetinvid, assetid, amount, mode) per staged position, in staging order
+        self.increments = []
+        # New rows as mutable lists so repeated positions can add to their amount
+        self.rows = {table: [] for table in self.INSERTS}
+        self._child_index = {table: {} for table in self.CHILD_TABLES.values()}
+        # Increments against rows that already existed in the database
+        self.updates = {table: [] for table in self.UPDATES}
+    
+    def stage(self, asset_id: int, amount: float, held_at: str):
+        """Stage one position exactly as allocate_asset_ref would write it"""
+        key = (asset_id, held_at)
+        position = self.positions.get(key)
+        
+        # A repeat with the same amount leaves assetinv as it is (child rows still grow)
+        if position is None or position[1] != amount:
+            self.held_at_totals[held_at] = self.held_at_totals.get(held_at, 0.0) + amount
+        
+        if position is None:
+            # Keys are pre-assigned so child rows never need LAST_INSERT_ID()
+            assetinv_id = self.next_id()
+            assetinv_row = [assetinv_id, asset_id, self.date_str, amount, held_at]
+            self.rows['assetinv'].append(assetinv_row)
+            self.positions[key] = [assetinv_id, amount, assetinv_row]
+            mode = 'insert'
+        else:
+            assetinv_id, org_amount, assetinv_row = position
+            if org_amount != amount:
+                position[1] = org_amount + amount
+                if assetinv_row is not None:
+                    assetinv_row[3] = position[1]
+                else:
+                    self.updates['assetinv'].append((amount, assetinv_id))
+            mode = 'merge' if assetinv_row is not None else 'update'
+        
+        # Child rows are split later for all positions at once
+        self.increments.append((assetinv_id, asset_id, amount, mode))
+    
+    def split_children(self, matrix: AllocationMatrix):
+        """Split all staged amounts across template lines and build child rows"""
+        if not self.increments:
+            return
+        
+        positions, columns, line_amounts = matrix.split(
+            [increment[1] for increment in self.increments],
+            [increment[2] for increment in self.increments]
+        )
+        
+        for position, column, allocated_amount in zip(positions.tolist(), columns.tolist(), line_amounts.tolist()):
+            assetinv_id, _, _, mode = self.increments[position]
+            tcode, code1, code2 = matrix.columns[column]
+            table = self.CHILD_TABLES[tcode]
+            child_key = (assetinv_id, code1, code2) if tcode == 'secind' else (assetinv_id, code1)
+            
+            if mode == 'insert':
+                child_row = list(child_key) + [allocated_amount]
+                self.rows[table].append(child_row)
+                self._child_index[table].setdefault(child_key, []).append(child_row)
+            elif mode == 'merge':
+                # UPDATE ... WHERE matches every child row with this key
+                for child_row in self._child_index[table].get(child_key, []):
+                    child_row[-1] = round(child_row[-1] + allocated_amount, 2)
+            else:
+                self.updates[table].append((allocated_amount,) + child_key)
+        
+        self.increments = []
+    
+    def allocated_totals(self) -> Dict[int, float]:
+        """assetinvalloc amount per new assetinvid, as split_children() built it"""
+        totals = {}
+        for row in self.rows['assetinvalloc']:
+            totals[row[0]] = totals.get(row[0], 0.0) + row[-1]
+        return totals
+    
+    def write(self, db: AssetDatabase, matrix: AllocationMatrix) -> Dict[str, int]:
+        """Write staged rows with batched executemany; caller owns the transaction"""
+        self.split_children(matrix)
+        
+        tables = self.tables or {}
+        counts = {}
+        for table, query in self.INSERTS.items():
+            rows = [tuple(row) for row in self.rows[table]]
+            counts[table] = len(rows)
+            if rows:
+                db.execute_many(query.format(table=tables.get(table, table)), rows, self.batch_size)
+        for table, query in self.UPDATES.items():
+            if self.updates[table]:
+                db.execute_many(query.format(table=tables.get(table, table)), self.updates[table], self.batch_size)
+        return counts
+
+
 class AssetAllocator:
     """Handles asset allocation operations"""
     
-    def __init__(self, db: AssetDatabase):
+    def __init__(self, db: AssetDatabase, template_cache: Optional[TemplateCache] = None):
         self.db = db
+        self.templates = template_cache or TemplateCache(db)
+        self.ids = IdBlockAllocator(db)
+        self.bulk = None  # AllocationBatch while bulk mode is active
+        self.staged_batch = None  # Flushed staging batch waiting for publish_staged()
     
     @staticmethod
     def mysql_date(dt) -> str:
@@ -116,9 +546,7 @@ class AssetAllocator:
     
     def reallocate(self, asset_id: int, as_of_date, amount: float):
         """Delete existing allocation and reallocate"""
-        self.db.open_db()
-        
-        try:
+        with self.db.session():
             # Get existing asset investment IDs
             date_str = self.mysql_date(as_of_date)
             query = """
@@ -149,77 +577,61 @@ class AssetAllocator:
             
             # Now allocate
             self.allocate(asset_id, as_of_date, amount)
-            
-        finally:
-            self.db.close_db()
     
     def allocate(self, asset_id: int, as_of_date, amount: float):
         """Allocate an asset based on its template"""
-        self.db.open_db()
-        
-        try:
-            self.db.begin_transaction()
-            
-            # Insert into assetinv
-            date_str = self.mysql_date(as_of_date)
-            insert_query = """
-                INSERT INTO assetinv(assetid, asofdate, amount) 
-                VALUES (%s, %s, %s)
-            """
-            self.db.execute_update(insert_query, (asset_id, date_str, amount))
-            
-            # Get the newly inserted assetinvid
-            self.db.cursor.execute("SELECT LAST_INSERT_ID() as id")
-            assetinv_id = self.db.cursor.fetchone()['id']
-            
-            # Get template details
-            template_query = """
-                SELECT tcode, tval1, tval2, prct 
-                FROM templatedetails td 
-                INNER JOIN asset a ON td.templateid = a.templateid 
-                WHERE a.assetid = %s
-            """
-            template_details = self.db.execute_query(template_query, (asset_id,))
-            
-            # Process each template detail
-            for detail in template_details:
-                tcode = detail['tcode'].lower()
-                tval1 = self.nullif(detail['tval1'], '0')
-                tval2 = self.nullif(detail['tval2'], '0')
-                prct = float(detail['prct'])
+        with self.db.session():
+            try:
+                self.db.begin_transaction()
                 
-                allocated_amount = round(amount * (prct / 100), 2)
+                # Insert into assetinv with an id from the reserved block, like allocate_asset_ref,
+                # so AUTO_INCREMENT never hands out an id the block still holds
+                date_str = self.mysql_date(as_of_date)
+                assetinv_id = self.ids.next_id()
+                insert_query = """
+                    INSERT INTO assetinv(assetinvid, assetid, asofdate, amount) 
+                    VALUES (%s, %s, %s, %s)
+                """
+                self.db.execute_update(insert_query, (assetinv_id, asset_id, date_str, amount))
                 
-                if tcode == 'alloc':
-                    insert_alloc = """
-                        INSERT INTO assetinvalloc(assetinvid, alloccode, amount) 
-                        VALUES (%s, %s, %s)
-                    """
-                    self.db.execute_update(insert_alloc, (assetinv_id, int(tval1), allocated_amount))
+                # Get template details
+                template_details = self.templates.details_for_asset(asset_id)
                 
-                elif tcode == 'secind':
-                    insert_secind = """
-                        INSERT INTO assetinvsecind(assetinvid, sec_id, ind_id, amount) 
-                        VALUES (%s, %s, %s, %s)
-                    """
-                    self.db.execute_update(insert_secind, (assetinv_id, int(tval1), int(tval2), allocated_amount))
+                # Process each template detail; largest-remainder split keeps each family summing to amount
+                allocated_amounts = split_amount(amount, template_details)
+                for detail, allocated_amount in zip(template_details, allocated_amounts):
+                    tcode = detail['tcode'].lower()
+                    tval1 = self.nullif(detail['tval1'], '0')
+                    tval2 = self.nullif(detail['tval2'], '0')
+                    
+                    if tcode == 'alloc':
+                        insert_alloc = """
+                            INSERT INTO assetinvalloc(assetinvid, alloccode, amount) 
+                            VALUES (%s, %s, %s)
+                        """
+                        self.db.execute_update(insert_alloc, (assetinv_id, int(tval1), allocated_amount))
+                    
+                    elif tcode == 'secind':
+                        insert_secind = """
+                            INSERT INTO assetinvsecind(assetinvid, sec_id, ind_id, amount) 
+                            VALUES (%s, %s, %s, %s)
+                        """
+                        self.db.execute_update(insert_secind, (assetinv_id, int(tval1), int(tval2), allocated_amount))
+                    
+                    elif tcode == 'inter':
+                        insert_inter = """
+                            INSERT INTO assetinvinter(assetinvid, intercode, amount) 
+                            VALUES (%s, %s, %s)
+                        """
+                        self.db.execute_update(insert_inter, (assetinv_id, int(tval1), allocated_amount))
                 
-                elif tcode == 'inter':
-                    insert_inter = """
-                        INSERT INTO assetinvinter(assetinvid, intercode, amount) 
-                        VALUES (%s, %s, %s)
-                    """
-                    self.db.execute_update(insert_inter, (assetinv_id, int(tval1), allocated_amount))
-            
-            self.db.commit()
-            print(f"Successfully allocated asset {asset_id} with amount {amount}")
-            
-        except Exception as e:
-            self.db.rollback()
-            print(f"Error in allocate: {e}")
-            raise
-        finally:
-            self.db.close_db()
+                self.db.commit()
+                print(f"Successfully allocated asset {asset_id} with amount {amount}")
+                
+            except Exception as e:
+                self.db.rollback()
+                print(f"Error in allocate: {e}")
+                raise
     
     def allocate_asset_ref(self, asset_id: int, as_of_date, amount: float, held_at: str):
         """Allocate an asset from the asset reference sheet
@@ -228,6 +640,13 @@ class AssetAllocator:
         if amount == 0:
             return
         
+        if self.bulk is not None:
+            template_details = self.templates.details_for_asset(asset_id)
+            if not template_details:
+                raise Exception(f"No template details found for asset {asset_id}")
+            self.bulk.stage(asset_id, amount, held_at)
+            return
+        
         try:
             self.db.begin_transaction()
             
@@ -250,10 +669,7 @@ class AssetAllocator:
                     update_query = "UPDATE assetinv SET amount = amount + %s WHERE assetinvid = %s"
                     self.db.execute_update(update_query, (amount, assetinv_id))
             else:
-                # Get max assetinvid
-                self.db.cursor.execute("SELECT MAX(assetinvid) as max_id FROM assetinv")
-                result = self.db.cursor.fetchone()
-                assetinv_id = (result['max_id'] or 0) + 1
+                assetinv_id = self.ids.next_id()
                 
                 # Insert new assetinv
                 insert_query = """
@@ -263,25 +679,17 @@ class AssetAllocator:
                 self.db.execute_update(insert_query, (assetinv_id, asset_id, date_str, amount, held_at))
             
             # Get template details
-            template_query = """
-                SELECT tcode, tval1, tval2, prct 
-                FROM templatedetails td 
-                INNER JOIN asset a ON td.templateid = a.templateid 
-                WHERE a.assetid = %s
-            """
-            template_details = self.db.execute_query(template_query, (asset_id,))
+            template_details = self.templates.details_for_asset(asset_id)
             
             if not template_details:
                 raise Exception(f"No template details found for asset {asset_id}")
             
-            # Process each template detail
-            for detail in template_details:
+            # Process each template detail; largest-remainder split keeps each family summing to amount
+            allocated_amounts = split_amount(amount, template_details)
+            for detail, allocated_amount in zip(template_details, allocated_amounts):
                 tcode = detail['tcode'].lower()
                 tval1 = self.nullif(detail['tval1'], '0')
                 tval2 = self.nullif(detail['tval2'], '0')
-                prct = float(detail['prct'])
-                
-                allocated_amount = round(amount * (prct / 100), 2)
                 
                 if tcode == 'alloc':
                     if dup_asset:
@@ -333,181 +741,562 @@ class AssetAllocator:
             print(f"Error in allocate_asset_ref: {e}")
             raise
     
-    def delete_asset_info(self, as_of_date):
-        """Delete asset information for a given date"""
-        self.db.open_db()
+    def begin_bulk(self, as_of_date, batch_size: int = 500, staged: bool = False, diff: bool = False):
+        """Collect allocate_asset_ref rows in memory until flush_bulk() writes them
         
-        try:
-            date_str = self.mysql_date(as_of_date)
-            
-            # Delete gains for the date
-            self.db.execute_update("DELETE FROM assetgain WHERE assetdate=%s", (date_str,))
+        With staged=True the rows go to the staging tables as a complete replacement
+        for the date, to be validated and swapped in by publish_staged(). With
+        diff=True flush_bulk() only touches positions that differ from what is stored."""
+        if staged and diff:
+            raise Exception("Staged and diff allocation cannot be combined")
+        date_str = self.mysql_date(as_of_date)
+        
+        if diff:
+            # Provisional negative ids; only inserted positions get real ones
+            provisional_ids = itertools.count(-1, -1)
+            self.bulk = AllocationBatch(date_str, lambda: next(provisional_ids), [], batch_size)
+            self.bulk.diff = True
+            print(f"Diff allocation started for {date_str}")
+            return
+        
+        if staged:
+            self.ensure_staging_tables()
+            with self.db.session():
+                try:
+                    self.db.begin_transaction()
+                    self.delete_holdings(date_str, STAGING_TABLES)
+                    self.db.commit()
+                except Exception:
+                    self.db.rollback()
+                    raise
+            existing = []
+        else:
+            with self.db.session():
+                existing = self.db.execute_query(
+                    "SELECT assetinvid, assetid, heldat, amount FROM assetinv WHERE asofdate=%s ORDER BY assetinvid",
+                    (date_str,)
+                )
+        
+        self.bulk = AllocationBatch(date_str, self.ids.next_id, existing, batch_size,
+                                    tables=STAGING_TABLES if staged else None)
+        print(f"Bulk allocation started for {date_str} (batch size {batch_size}{', staged' if staged else ''})")
+    
+    def flush_bulk(self) -> Dict[str, int]:
+        """Write all staged rows in a single transaction and leave bulk mode"""
+        batch, self.bulk = self.bulk, None
+        if batch is None:
+            return {}
+        if batch.diff:
+            return self._apply_diff(batch)
+        
+        with self.db.session():
+            try:
+                self.db.begin_transaction()
+                counts = batch.write(self.db, self.templates.matrix())
+                self.db.commit()
+            except Exception as e:
+                self.db.rollback()
+                print(f"Error in flush_bulk: {e}")
+                raise
+        
+        if batch.tables:
+            self.staged_batch = batch
+        
+        print("Bulk allocation wrote " + ", ".join(f"{(batch.tables or {}).get(table, table)}={count}"
+                                                    for table, count in counts.items()))
+        return counts
+    
+    @staticmethod
+    def _child_signature(children: Dict[str, List[tuple]]) -> tuple:
+        """Comparable form of a position's child rows: sorted (codes..., amount) per table"""
+        return tuple(
+            tuple(sorted(tuple(int(code) for code in row[:-1]) + (round(float(row[-1]), 2),)
+                         for row in children.get(table, [])))
+            for table in AllocationBatch.CHILD_COLUMNS
+        )
+    
+    def _apply_diff(self, batch: AllocationBatch) -> Dict[str, int]:
+        """Insert, update or delete only the positions (and child rows) that differ from storage"""
+        batch.split_children(self.templates.matrix())
+        date_str = batch.date_str
+        
+        # Desired state: (assetid, heldat) -> assetinv row and child rows without assetinvid
+        desired_children = {}
+        for table in AllocationBatch.CHILD_COLUMNS:
+            for row in batch.rows[table]:
+                desired_children.setdefault(row[0], {}).setdefault(table, []).append(tuple(row[1:]))
+        desired = {(row[1], row[4]): row for row in batch.rows['assetinv']}
+        
+        with self.db.session():
+            stored_rows = self.db.execute_query(
+                "SELECT assetinvid, assetid, heldat, amount FROM assetinv WHERE asofdate=%s ORDER BY assetinvid",
+                (date_str,)
+            )
+            stored_children = {}
+            for table, columns in AllocationBatch.CHILD_COLUMNS.items():
+                column_list = ', '.join(f"c.{column}" for column in columns)
+                rows = self.db.execute_query(f"""
+                    SELECT c.assetinvid, {column_list}, c.amount FROM {table} c
+                    INNER JOIN assetinv ai ON c.assetinvid = ai.assetinvid
+                    WHERE ai.asofdate=%s
+                """, (date_str,))
+                for row in rows:
+                    stored_children.setdefault(row['assetinvid'], {}).setdefault(table, []).append(
+                        tuple(row[column] for column in columns) + (row['amount'],)
+                    )
             
-            # Delete old gains (older than 24 months)
-            old_date = as_of_date - timedelta(days=730)
-            old_date_str = self.mysql_date(old_date)
-            self.db.execute_update("DELETE FROM assetgain WHERE assetdate<%s", (old_date_str,))
+            deleted_ids = []
+            updated = []  # (stored assetinvid, desired assetinv row)
+            seen = set()
+            for row in stored_rows:
+                key = (row['assetid'], row['heldat'])
+                wanted = desired.get(key)
+                if wanted is None or key in seen:
+                    deleted_ids.append(row['assetinvid'])
+                    continue
+                seen.add(key)
+                same_amount = abs(float(row['amount']) - wanted[3]) < 0.005
+                same_children = (self._child_signature(stored_children.get(row['assetinvid'], {})) ==
+                                 self._child_signature(desired_children.get(wanted[0], {})))
+                if not (same_amount and same_children):
+                    updated.append((row['assetinvid'], wanted))
+            inserted = [row for key, row in desired.items() if key not in seen]
             
-            # Get all assetinvid for the date and delete related records
-            query = "SELECT assetinvid FROM assetinv WHERE asofdate=%s"
-            results = self.db.execute_query(query, (date_str,))
+            # Child rows of changed positions are replaced wholesale under their stored id
+            replaced_ids = deleted_ids + [assetinv_id for assetinv_id, _ in updated]
+            new_ids = {row[0]: self.ids.next_id() for row in inserted}
+            new_ids.update({row[0]: assetinv_id for assetinv_id, row in updated})
             
-            for row in results:
-                assetinv_id = row['assetinvid']
-                self.db.execute_update("DELETE FROM assetinvalloc WHERE assetinvid=%s", (assetinv_id,))
-                self.db.execute_update("DELETE FROM assetinvsecind WHERE assetinvid=%s", (assetinv_id,))
-                self.db.execute_update("DELETE FROM assetinvinter WHERE assetinvid=%s", (assetinv_id,))
-                self.db.execute_update("DELETE FROM assetinv WHERE assetinvid=%s", (assetinv_id,))
+            deleted_set = set(deleted_ids)
             
-            self.db.commit()
-            print(f"Deleted asset info for date {date_str}")
+            try:
+                self.db.begin_transaction()
+                for start in range(0, len(replaced_ids), batch.batch_size):
+                    chunk = replaced_ids[start:start + batch.batch_size]
+                    placeholders = ', '.join(['%s'] * len(chunk))
+                    for table in AllocationBatch.CHILD_COLUMNS:
+                        self.db.execute_update(f"DELETE FROM {table} WHERE assetinvid IN ({placeholders})", tuple(chunk))
+                    deleted_chunk = [assetinv_id for assetinv_id in chunk if assetinv_id in deleted_set]
+                    if deleted_chunk:
+                        self.db.execute_update(
+                            f"DELETE FROM assetinv WHERE assetinvid IN ({', '.join(['%s'] * len(deleted_chunk))})",
+                            tuple(deleted_chunk)
+                        )
+                
+                if updated:
+                    self.db.execute_many("UPDATE assetinv SET amount=%s WHERE assetinvid=%s",
+                                         [(row[3], assetinv_id) for assetinv_id, row in updated], batch.batch_size)
+                if inserted:
+                    self.db.execute_many(AllocationBatch.INSERTS['assetinv'].format(table='assetinv'),
+                                         [(new_ids[row[0]],) + tuple(row[1:]) for row in inserted], batch.batch_size)
+                for table in AllocationBatch.CHILD_COLUMNS:
+                    child_rows = [(new_ids[row[0]],) + tuple(row[1:]) for row in batch.rows[table] if row[0] in new_ids]
+                    if child_rows:
+                        self.db.execute_many(AllocationBatch.INSERTS[table].format(table=table),
+                                             child_rows, batch.batch_size)
+                self.db.commit()
+            except Exception as e:
+                self.db.rollback()
+                print(f"Error applying allocation diff: {e}")
+                raise
+        
+        counts = {
+            'inserted': len(inserted),
+            'updated': len(updated),
+            'deleted': len(deleted_ids),
+            'unchanged': len(stored_rows) - len(updated) - len(deleted_ids),
+        }
+        print(f"Diff allocation for {date_str}: " + ", ".join(f"{name}={count}" for name, count in counts.items()))
+        return counts
+    
+    def ensure_staging_tables(self):
+        """Create the staging tables as copies of the holdings tables if missing"""
+        with self.db.session():
+            for table, staging_table in STAGING_TABLES.items():
+                self.db.execute_update(f"CREATE TABLE IF NOT EXISTS {staging_table} LIKE {table}")
+    
+    def validate_staged(self, date_str: str, expected_totals: Dict[str, float],
+                        expected_allocated: Dict[int, float], tolerance: float = 0.01) -> List[str]:
+        """Check staged totals per heldat and the assetinvalloc total of each position
+        
+        Allocation rows are compared with the split the batch computed rather than with
+        the position amount: templates whose alloc lines do not add up to 100% (or have
+        none) and repeated positions with the same amount legitimately differ from it."""
+        problems = []
+        
+        rows = self.db.execute_query(
+            f"SELECT heldat, SUM(amount) AS total FROM {STAGING_TABLES['assetinv']} WHERE asofdate=%s GROUP BY heldat",
+            (date_str,)
+        )
+        staged_totals = {row['heldat']: float(row['total']) for row in rows}
+        for held_at in sorted(set(expected_totals) | set(staged_totals)):
+            expected = expected_totals.get(held_at, 0.0)
+            staged = staged_totals.get(held_at, 0.0)
+            if abs(expected - staged) > tolerance:
+                problems.append(f"{held_at}: expected {expected:,.2f}, staged {staged:,.2f}")
+        
+        rows = self.db.execute_query(f"""
+            SELECT ai.assetinvid, COALESCE(SUM(c.amount), 0) AS allocated
+            FROM {STAGING_TABLES['assetinv']} ai
+            LEFT JOIN {STAGING_TABLES['assetinvalloc']} c ON c.assetinvid = ai.assetinvid
+            WHERE ai.asofdate=%s
+            GROUP BY ai.assetinvid
+        """, (date_str,))
+        staged_allocated = {row['assetinvid']: float(row['allocated']) for row in rows}
+        for assetinv_id in sorted(set(expected_allocated) | set(staged_allocated)):
+            expected = expected_allocated.get(assetinv_id, 0.0)
+            allocated = staged_allocated.get(assetinv_id)
+            if allocated is None:
+                problems.append(f"assetinvid {assetinv_id}: missing from {STAGING_TABLES['assetinv']}")
+            elif abs(expected - allocated) > tolerance:
+                problems.append(f"assetinvid {assetinv_id}: expected allocation {expected:,.2f}, "
+                                f"staged {allocated:,.2f}")
+        
+        return problems
+    
+    def publish_staged(self, delete_gains: bool = False) -> Dict[str, int]:
+        """Validate the flushed staging batch and swap it into the live tables in one transaction"""
+        batch, self.staged_batch = self.staged_batch, None
+        if batch is None:
+            raise Exception("No staged allocation to publish")
+        date_str = batch.date_str
+        
+        with self.db.session():
+            problems = self.validate_staged(date_str, batch.held_at_totals, batch.allocated_totals())
+            if problems:
+                try:
+                    self.db.begin_transaction()
+                    self.delete_holdings(date_str, STAGING_TABLES)
+                    self.db.commit()
+                except Exception:
+                    self.db.rollback()
+                    raise
+                for problem in problems:
+                    print(f"  - {problem}")
+                raise Exception(f"Staged allocation for {date_str} failed validation; live data left unchanged")
             
-        except Exception as e:
-            print(f"Error deleting asset info: {e}")
-            raise
-        finally:
-            self.db.close_db()
+            try:
+                self.db.begin_transaction()
+                if delete_gains:
+                    self.delete_gains(date_str)
+                self.delete_holdings(date_str)
+                
+                # Columns are listed so staging tables created from an older schema still publish
+                stage = STAGING_TABLES['assetinv']
+                columns = 'assetinvid, assetid, asofdate, amount, heldat'
+                counts = {'assetinv': self.db.execute_update(
+                    f"INSERT INTO assetinv({columns}) SELECT {columns} FROM {stage} WHERE asofdate=%s", (date_str,)
+                )}
+                for child, child_columns in AllocationBatch.CHILD_COLUMNS.items():
+                    columns = ('assetinvid',) + child_columns + ('amount',)
+                    counts[child] = self.db.execute_update(f"""
+                        INSERT INTO {child}({', '.join(columns)})
+                        SELECT {', '.join(f'c.{column}' for column in columns)} FROM {STAGING_TABLES[child]} c
+                        INNER JOIN {stage} ai ON c.assetinvid = ai.assetinvid
+                        WHERE ai.asofdate=%s
+                    """, (date_str,))
+                
+                self.delete_holdings(date_str, STAGING_TABLES)
+                self.db.commit()
+            except Exception as e:
+                self.db.rollback()
+                print(f"Error publishing staged allocation: {e}")
+                raise
+        
+        print(f"Published staged allocation for {date_str}: " +
+              ", ".join(f"{table}={count}" for table, count in counts.items()))
+        return counts
+    
+    def delete_holdings(self, date_str: str, tables: Optional[Dict[str, str]] = None) -> Dict[str, int]:
+        """Delete a date's assetinv rows and their child rows in a constant number of statements
+        Note: runs inside the caller's transaction"""
+        tables = tables or {}
+        assetinv = tables.get('assetinv', 'assetinv')
+        counts = {}
+        
+        # Child rows first, joined to their parent on asofdate
+        for child in ('assetinvalloc', 'assetinvsecind', 'assetinvinter'):
+            counts[child] = self.db.execute_update(f"""
+                DELETE c FROM {tables.get(child, child)} c
+                INNER JOIN {assetinv} ai ON c.assetinvid = ai.assetinvid
+                WHERE ai.asofdate=%s
+            """, (date_str,))
+        counts['assetinv'] = self.db.execute_update(f"DELETE FROM {assetinv} WHERE asofdate=%s", (date_str,))
+        return counts
+    
+    def delete_gains(self, date_str: str) -> int:
+        """Delete gains for the date and old gains (older than 24 months)
+        Note: runs inside the caller's transaction"""
+        old_date_str = self.mysql_date(datetime.strptime(date_str, '%Y-%m-%d') - timedelta(days=730))
+        return self.db.execute_update(
+            "DELETE FROM assetgain WHERE assetdate=%s OR assetdate<%s", (date_str, old_date_str)
+        )
+    
+    def delete_asset_info(self, as_of_date) -> Dict[str, int]:
+        """Delete asset information for a given date and return rows deleted per table"""
+        with self.db.session():
+            try:
+                self.db.begin_transaction()
+                date_str = self.mysql_date(as_of_date)
+                
+                counts = {'assetgain': self.delete_gains(date_str)}
+                counts.update(self.delete_holdings(date_str))
+                
+                self.db.commit()
+                print(f"Deleted asset info for date {date_str}: " +
+                      ", ".join(f"{table}={count}" for table, count in counts.items()))
+                return counts
+                
+            except Exception as e:
+                self.db.rollback()
+                print(f"Error deleting asset info: {e}")
+                raise
+
+
+# Earliest date requested when computing since-inception returns
+INCEPTION_START = datetime(1970, 1, 2)
 
 
 class GainCalculator:
     """Handles gain/performance calculations from Yahoo Finance and Morningstar"""
     
-    def __init__(self, db: AssetDatabase):
+    def __init__(self, db: AssetDatabase, max_workers: int = 8, fetcher: Optional[PriceFetcher] = None,
+                 price_cache: Optional[PriceCache] = None, calendar: Optional[TradingCalendar] = None,
+                 providers: Optional[ProviderChain] = None, horizons: Tuple[str, ...] = ()):
         self.db = db
+        # Extra horizons (keys of gains_matrix.HORIZONS) written to assetgainhorizon
+        unknown = [horizon for horizon in horizons if horizon not in HORIZONS]
+        if unknown:
+            raise Exception(f"Unknown gain horizons: {', '.join(unknown)}")
+        self.horizons = tuple(horizons)
+        self.max_workers = max_workers  # Concurrent ticker fetches
+        self.fetcher = fetcher or PriceFetcher()
+        # Morningstar first, falling back to Yahoo, unless a ticker last succeeded elsewhere
+        self.providers = providers or ProviderChain([MorningstarProvider(self.fetcher, price_cache),
+                                                       YahooProvider(self.fetcher)])
+        self.price_cache = price_cache  # When set, Yahoo history is fetched incrementally
+        self._calendar = calendar
+    
+    @property
+    def calendar(self) -> TradingCalendar:
+        """Trading calendar, loaded from the holiday table on first use"""
+        if self._calendar is None:
+            with self.db.session():
+                self._calendar = TradingCalendar.load(self.db)
+        return self._calendar
     
     @staticmethod
     def is_market_open(dt: datetime, db: AssetDatabase) -> bool:
-        """Check if market is open on a given date"""
+        """Check if market is open on a given date (one query; prefer GainCalculator.calendar)"""
         # Check if weekend
         if dt.weekday() in [5, 6]:  # Saturday or Sunday
             return False
         
         # Check if holiday
         date_str = AssetAllocator.mysql_date(dt)
-        query = "SELECT * FROM holiday WHERE YEAR(holiday_date)=%s AND holiday_date=%s"
-        results = db.execute_query(query, (dt.year, date_str))
+        query = "SELECT 1 FROM holiday WHERE holiday_date=%s"
+        results = db.execute_query(query, (date_str,))
         
         return len(results) == 0
     
     def trading_date_add(self, dtype: str, num_periods: int, dt: datetime) -> datetime:
-        """Add periods to date, adjusting for market closures"""
+        """Subtract periods from date, moving back to the previous trading day"""
         if dtype == 'ww':  # weeks
-            target_date = dt - timedelta(weeks=num_periods)
+            return self.calendar.weeks_back(dt, num_periods)
         elif dtype == 'd':  # days
-            target_date = dt - timedelta(days=num_periods)
-        else:
-            target_date = dt
+            return self.calendar.days_back(dt, num_periods)
+        return self.calendar.previous_trading_day(dt)
+    
+    def provider(self, name: str) -> PriceProvider:
+        """Provider by name from the chain, or a standalone one for 'yahoo' / 'morningstar'"""
+        provider = self.providers.provider(name)
+        if provider is None:
+            provider = {'yahoo': YahooProvider, 'morningstar': MorningstarProvider}[name](self.fetcher)
+        return provider
+    
+    def lookback_prices(self, ticker: str, dates: List[datetime], provider: Optional[PriceProvider] = None,
+                        window_start: Optional[datetime] = None) -> Optional[Dict[str, float]]:
+        """Closes for the lookback window (from window_start if earlier than dates[-1]) from a
+        price provider, directly or through the price cache"""
+        provider = provider or self.provider('yahoo')
+        start = min(dates[-1], window_start) if window_start else dates[-1]
+        if self.price_cache is None:
+            return provider.fetch_prices(ticker, start, dates[0])
         
-        # Adjust for non-trading days
-        if not self.is_market_open(target_date, self.db):
-            for i in range(3):
-                target_date = target_date - timedelta(days=1)
-                if self.is_market_open(target_date, self.db):
-                    break
+        # Only request the part of the window the cache has not covered yet
+        for start_date, end_date in self.price_cache.missing_ranges(ticker, start, dates[0]):
+            # The end date is exclusive, so ask through the following day
+            prices = provider.fetch_prices(ticker, start_date, end_date + timedelta(days=1))
+            if prices is None:
+                covered = self.price_cache.fetched_range(ticker)
+                if covered is None:
+                    return None
+                if start_date <= INCEPTION_START and end_date.strftime('%Y-%m-%d') < covered[0]:
+                    # Nothing before the first close: record the range so inception runs stop asking
+                    self.price_cache.store(ticker, {}, start_date, end_date)
+                continue
+            self.price_cache.store(ticker, prices, start_date, end_date)
         
-        return target_date
+        # The whole window, so lookback dates without a close can fall back to the one before
+        return self.price_cache.history(ticker, start, dates[0])
     
-    def calc_gain_from_yahoo(self, ticker: str, dates: List[datetime]) -> bool:
-        """Calculate gains from Yahoo Finance"""
-        print(f"Calculating gains from Yahoo for {ticker}")
+    def repair_prices(self, tickers: List[str], as_of_date: datetime, days: int = 366) -> Dict[str, int]:
+        """Drop and refetch the cached history of tickers; returns the number of closes stored per ticker"""
+        if self.price_cache is None:
+            raise Exception("repair_prices requires a price cache")
         
-        if ticker == 'FCASH':
-            return False
+        start_date = as_of_date - timedelta(days=days)
+        end_date = as_of_date + timedelta(days=1)
+        stored = {}
+        for ticker in tickers:
+            self.price_cache.invalidate(ticker)
+            prices = self.providers.fetch(
+                ticker,
+                lambda provider: provider.fetch_prices(ticker, start_date, end_date) if provider.kind == 'prices' else None
+            )
+            if prices is None:
+                print(f"Could not refetch price history for {ticker}")
+                continue
+            self.price_cache.store(ticker, prices, start_date, as_of_date)
+            stored[ticker] = len(prices)
+            print(f"Refetched {len(prices)} closes for {ticker}")
+        return stored
+    
+    @staticmethod
+    def compute_gains(price_data: Dict[str, float], dates: List[datetime]) -> List[float]:
+        """Percent change from each lookback date to dates[0], using the last close on or before each date"""
+        return lookback_gains({'': price_data}, dates)['']
+    
+    def insert_gains(self, as_of_date: datetime, gains_by_ticker: Dict[str, List[float]]) -> int:
+        """Insert one assetgain row per ticker in a single batch"""
+        date_str = AssetAllocator.mysql_date(as_of_date)
+        rows = [
+            (ticker, date_str) + tuple(gains[i] if len(gains) > i else 0 for i in range(1, 7))
+            for ticker, gains in gains_by_ticker.items()
+        ]
+        if not rows:
+            return 0
         
-        try:
-            # Build Yahoo Finance CSV URL
-            start_date = dates[-1]
-            end_date = dates[0]
-            
-            url = (f"https://query1.finance.yahoo.com/v7/finance/download/{ticker}"
-                   f"?period1={int(start_date.timestamp())}"
-                   f"&period2={int(end_date.timestamp())}"
-                   f"&interval=1d&events=history")
-            
-            response = requests.get(url)
-            if response.status_code != 200:
-                print(f"Failed to fetch data for {ticker}")
-                return False
-            
-            # Parse CSV data
-            csv_data = csv.DictReader(StringIO(response.text))
-            price_data = {}
-            
-            for row in csv_data:
-                date_str = row['Date']
-                close_price = float(row['Close'])
-                price_data[date_str] = close_price
-            
-            # Calculate gains
-            gains = [0] * (len(dates))
-            curr_price = None
-            
-            for i, date in enumerate(dates):
-                date_str = date.strftime('%Y-%m-%d')
-                if date_str in price_data:
-                    if i == 0:
-                        curr_price = price_data[date_str]
-                    else:
-                        prev_price = price_data[date_str]
-                        if curr_price and prev_price:
-                            gains[i] = round(((curr_price - prev_price) / prev_price) * 100, 2)
-            
-            # Insert into database
-            self.db.open_db()
-            date_str = AssetAllocator.mysql_date(dates[0])
-            
-            insert_query = """
-                INSERT INTO assetgain 
-                (ticker, assetdate, oneweekgain, twoweekgain, onemonthgain, 
-                 threemonthgain, sixmonthgain, oneyeargain) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            self.db.execute_update(insert_query, (
-                ticker, date_str, 
-                gains[1] if len(gains) > 1 else 0,
-                gains[2] if len(gains) > 2 else 0,
-                gains[3] if len(gains) > 3 else 0,
-                gains[4] if len(gains) > 4 else 0,
-                gains[5] if len(gains) > 5 else 0,
-                gains[6] if len(gains) > 6 else 0
-            ))
+        insert_query = """
+            INSERT INTO assetgain 
+            (ticker, assetdate, oneweekgain, twoweekgain, onemonthgain, 
+             threemonthgain, sixmonthgain, oneyeargain) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        with self.db.session():
+            # One multi-row INSERT for the whole run
+            inserted = self.db.execute_many(insert_query, rows, batch_size=len(rows))
             self.db.commit()
-            self.db.close_db()
-            
-            print(f"Successfully calculated gains for {ticker}")
-            return True
-            
-        except Exception as e:
-            print(f"Error calculating gains from Yahoo for {ticker}: {e}")
-            return False
+        return inserted
     
-    def calc_gain_from_morningstar(self, ticker: str, dates: List[datetime]) -> bool:
-        """Calculate gains from Morningstar"""
-        print(f"Attempting to calculate gains from Morningstar for {ticker}")
+    def fetch_ticker(self, ticker: str, dates: List[datetime], window_start: Optional[datetime] = None
+                     ) -> Tuple[Optional[List[float]], Optional[Dict[str, float]]]:
+        """Fetch stage for one ticker down the provider chain: (gains, None) or (None, closes)
         
-        try:
-            url = f"https://performance.morningstar.com/Performance/fund/trailing-total-returns.action?t={ticker}&ops=clear"
-            response = requests.get(url, timeout=10)
-            
-            if response.status_code != 200:
-                return False
-            
-            # Parse HTML for performance data
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # This is a simplified version - actual parsing would need to match the HTML structure
-            # For now, return False to fall back to Yahoo
-            return False
-            
-        except Exception as e:
-            print(f"Error fetching from Morningstar: {e}")
-            return False
+        With window_start set, closes back to that date are also fetched when a
+        returns-only provider supplied the gains, so extra horizons can be computed."""
+        def attempt(provider: PriceProvider):
+            if provider.kind == 'gains':
+                gains = provider.fetch_gains(ticker, dates)
+                return None if gains is None else (gains, None)
+            prices = self.lookback_prices(ticker, dates, provider, window_start)
+            return None if prices is None else (None, prices)
+        
+        gains, prices = self.providers.fetch(ticker, attempt) or (None, None)
+        if gains is not None and window_start is not None:
+            for provider in self.providers.order_for(ticker):
+                if provider.kind == 'prices':
+                    prices = self.lookback_prices(ticker, dates, provider, window_start)
+                    if prices is not None:
+                        break
+        return gains, prices
+    
+    def fetch_all(self, tickers: List[str], dates: List[datetime], window_start: Optional[datetime] = None
+                  ) -> Tuple[Dict[str, List[float]], Dict[str, Dict[str, float]]]:
+        """Fetch all tickers concurrently: (gains from returns providers, closes by ticker), in ticker order"""
+        provider_gains = {}
+        prices_by_ticker = {}
+        started = time.perf_counter()
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_ticker, ticker, dates, window_start): ticker for ticker in tickers}
+            for future in as_completed(futures):
+                ticker = futures[future]
+                gains, price_data = future.result()
+                if gains is not None:
+                    provider_gains[ticker] = gains
+                if price_data is not None:
+                    prices_by_ticker[ticker] = price_data
+                if gains is None and price_data is None:
+                    print(f"No price data for {ticker}")
+        
+        print(f"Fetched gains for {len(set(provider_gains) | set(prices_by_ticker))}/{len(tickers)} tickers in "
+              f"{time.perf_counter() - started:.2f}s")
+        
+        # Keep the insert order stable regardless of which responses arrived first
+        return ({ticker: provider_gains[ticker] for ticker in tickers if ticker in provider_gains},
+                {ticker: prices_by_ticker[ticker] for ticker in tickers if ticker in prices_by_ticker})
+    
+    @staticmethod
+    def merge_gains(tickers: List[str], provider_gains: Dict[str, List[float]],
+                    prices_by_ticker: Dict[str, Dict[str, float]], dates: List[datetime]) -> Dict[str, List[float]]:
+        """assetgain values per ticker: returns-provider gains where available, else computed from closes"""
+        price_only = {ticker: prices for ticker, prices in prices_by_ticker.items() if ticker not in provider_gains}
+        gains_by_ticker = dict(provider_gains, **lookback_gains(price_only, dates))
+        return {ticker: gains_by_ticker[ticker] for ticker in tickers if ticker in gains_by_ticker}
+    
+    def horizon_starts(self, as_of_date: datetime) -> Dict[str, Optional[datetime]]:
+        """Start trading day of each configured horizon (None = since inception)"""
+        starts = {}
+        for horizon in self.horizons:
+            kind, count = HORIZONS[horizon]
+            if kind == 'weeks':
+                starts[horizon] = self.calendar.weeks_back(as_of_date, count)
+            elif kind == 'ytd':
+                starts[horizon] = self.calendar.previous_trading_day(as_of_date.replace(month=1, day=1) - timedelta(days=1))
+            elif kind == 'years':
+                # Feb 29 falls back to Feb 28 in non-leap years
+                day = min(as_of_date.day, 28) if as_of_date.month == 2 else as_of_date.day
+                starts[horizon] = self.calendar.previous_trading_day(
+                    as_of_date.replace(year=as_of_date.year - count, day=day))
+            else:
+                starts[horizon] = None
+        return starts
+    
+    def insert_horizon_gains(self, as_of_date: datetime, returns) -> int:
+        """Upsert long-format horizon returns (output of gains_matrix.horizon_returns) into assetgainhorizon"""
+        if len(returns) == 0:
+            return 0
+        
+        date_str = AssetAllocator.mysql_date(as_of_date)
+        rows = [
+            (ticker, date_str, horizon, startdate, float(gain), int(annualized))
+            for ticker, horizon, startdate, gain, annualized in returns[
+                ['ticker', 'horizon', 'startdate', 'gain', 'annualized']].itertuples(index=False)
+        ]
+        with self.db.session():
+            self.db.execute_update("""
+                CREATE TABLE IF NOT EXISTS assetgainhorizon (
+                    ticker VARCHAR(20) NOT NULL,
+                    assetdate DATE NOT NULL,
+                    horizon VARCHAR(16) NOT NULL,
+                    startdate DATE NOT NULL,
+                    gain DECIMAL(12, 2) NOT NULL,
+                    annualized TINYINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (ticker, assetdate, horizon)
+                )
+            """)
+            inserted = self.db.execute_many("""
+                INSERT INTO assetgainhorizon (ticker, assetdate, horizon, startdate, gain, annualized)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE startdate=VALUES(startdate), gain=VALUES(gain), annualized=VALUES(annualized)
+            """, rows, batch_size=len(rows))
+            self.db.commit()
+        return inserted
     
     def calculate_gains(self, as_of_date: datetime):
         """Calculate gains for all assets"""
-        self.db.open_db()
-        
-        try:
+        with self.db.session():
             # Adjust date if weekend
             dt_today = as_of_date
             if dt_today.weekday() == 6:  # Sunday
@@ -528,31 +1317,50 @@ class GainCalculator:
             
             # Get distinct tickers
             query = "SELECT DISTINCT ticker FROM asset WHERE benchmark != '' AND benchmark IS NOT NULL"
-            results = self.db.execute_query(query)
-            
-            for row in results:
-                ticker = row['ticker']
-                # Try Morningstar first, fall back to Yahoo
-                if not self.calc_gain_from_morningstar(ticker, dates):
-                    self.calc_gain_from_yahoo(ticker, dates)
-            
-            print("Gain calculation completed")
-            
-        finally:
-            self.db.close_db()
+            tickers = [row['ticker'] for row in self.db.execute_query(query)]
+        
+        # Extra horizons widen the price window; since-inception reaches back to the first close
+        starts = self.horizon_starts(dt_today)
+        window_start = None
+        if starts:
+            window_start = min((start for start in starts.values() if start is not None),
+                               default=dates[-1])
+            if None in starts.values():
+                window_start = INCEPTION_START
+        
+        # Fetch every ticker concurrently, then compute and insert in one batch
+        self.fetcher.metrics.reset()
+        provider_gains, prices_by_ticker = self.fetch_all(tickers, dates, window_start)
+        self.providers.save()
+        print("Provider metrics:")
+        self.fetcher.metrics.report()
+        gains_by_ticker = self.merge_gains(tickers, provider_gains, prices_by_ticker, dates)
+        inserted = self.insert_gains(dates[0], gains_by_ticker)
+        print(f"Inserted {inserted} gain rows")
+        
+        if starts:
+            returns = horizon_returns(prices_by_ticker, dt_today, starts)
+            inserted = self.insert_horizon_gains(dt_today, returns)
+            print(f"Inserted {inserted} horizon gain rows ({', '.join(self.horizons)})")
+        
+        print("Gain calculation completed")
 
 
 class TemplateManager:
     """Manages asset templates"""
     
-    def __init__(self, db: AssetDatabase):
+    def __init__(self, db: AssetDatabase, template_cache: Optional[TemplateCache] = None):
         self.db = db
+        self.template_cache = template_cache
+    
+    def _templates_changed(self):
+        """Invalidate the shared template cache after a committed write"""
+        if self.template_cache:
+            self.template_cache.invalidate()
     
     def add_template_detail_alloc(self, template_id: int, allocations: List[Tuple[str, float]]):
         """Add allocation template details"""
-        self.db.open_db()
-        
-        try:
+        with self.db.session():
             for alloc_name, alloc_prct in allocations:
                 # Get alloccode
                 query = "SELECT alloccode FROM alloctype WHERE allocdesc=%s"
@@ -568,16 +1376,12 @@ class TemplateManager:
                     self.db.execute_update(insert_query, (template_id, alloccode, alloc_prct))
             
             self.db.commit()
+            self._templates_changed()
             print(f"Added allocation template details for template {template_id}")
-            
-        finally:
-            self.db.close_db()
     
     def add_template_detail_inter(self, template_id: int, interests: List[Tuple[str, float]]):
         """Add interest template details"""
-        self.db.open_db()
-        
-        try:
+        with self.db.session():
             for inter_name, alloc_prct in interests:
                 # Get intercode
                 query = "SELECT intercode FROM inter WHERE inter_name=%s"
@@ -593,16 +1397,12 @@ class TemplateManager:
                     self.db.execute_update(insert_query, (template_id, intercode, alloc_prct))
             
             self.db.commit()
+            self._templates_changed()
             print(f"Added interest template details for template {template_id}")
-            
-        finally:
-            self.db.close_db()
     
     def add_template_detail_secind(self, template_id: int, sectors: List[Tuple[str, str, float]]):
         """Add sector/industry template details"""
-        self.db.open_db()
-        
-        try:
+        with self.db.session():
             for sector_name, ind_name, alloc_prct in sectors:
                 # Get sec_id
                 query = "SELECT sec_id FROM sector WHERE sec_name=%s"
@@ -626,18 +1426,13 @@ class TemplateManager:
                     self.db.execute_update(insert_query, (template_id, sec_id, ind_id, alloc_prct))
             
             self.db.commit()
+            self._templates_changed()
             print(f"Added sector/industry template details for template {template_id}")
-            
-        finally:
-            self.db.close_db()
     
     def delete_template_details(self, template_id: int):
         """Delete all template details for a template"""
-        self.db.open_db()
-        
-        try:
+        with self.db.session():
             self.db.execute_update("DELETE FROM templatedetails WHERE templateid=%s", (template_id,))
             self.db.commit()
+            self._templates_changed()
             print(f"Deleted template details for template {template_id}")
-        finally:
-            self.db.close_db()
@@ -0,0 +1,235 @@
+"""
+Return Attribution
+Joins the holdings of a date with per-ticker gains in memory and breaks the
+portfolio return down into weighted contributions by holding, account,
+allocation type, sector and interest type
+"""
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Periods stored as columns of assetgain; any other horizon is read from assetgainhorizon
+GAIN_COLUMNS = {
+    '1w': 'oneweekgain',
+    '2w': 'twoweekgain',
+    '1m': 'onemonthgain',
+    '3m': 'threemonthgain',
+    '6m': 'sixmonthgain',
+    '1y': 'oneyeargain',
+}
+
+# Dimension -> (child table, code column, query returning code and name)
+CHILD_DIMENSIONS = {
+    'alloc': ('assetinvalloc', 'alloccode', "SELECT alloccode AS code, allocdesc AS name FROM alloctype"),
+    'sector': ('assetinvsecind', 'sec_id', "SELECT sec_id AS code, sec_name AS name FROM sector"),
+    'inter': ('assetinvinter', 'intercode', "SELECT intercode AS code, inter_name AS name FROM inter"),
+}
+
+GROUP_COLUMNS = ['name', 'amount', 'weight', 'contribution', 'return']
+
+
+def _day(value) -> str:
+    return value if isinstance(value, str) else value.strftime('%Y-%m-%d')
+
+
+def group_contributions(frame: pd.DataFrame, key: str, total: float) -> pd.DataFrame:
+    """
+    Sum weighted contributions per group
+
+    Args:
+        frame: Rows with key, name, amount and gain (percent) columns
+        key: Column to group by
+        total: Portfolio amount the weights are taken against
+
+    Returns:
+        DataFrame indexed by key with name, amount, weight (fraction of the portfolio),
+        contribution (percentage points of portfolio return) and return (the group's own
+        amount-weighted return in percent), largest contribution first
+    """
+    if frame.empty or not total:
+        return pd.DataFrame(columns=GROUP_COLUMNS).rename_axis(key)
+
+    frame = frame.assign(weighted=frame['amount'].to_numpy() * frame['gain'].to_numpy())
+    grouped = frame.groupby(key, sort=False).agg(name=('name', 'first'), amount=('amount', 'sum'),
+                                                 weighted=('weighted', 'sum'))
+    amounts = grouped['amount'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.where(amounts != 0, grouped['weighted'].to_numpy() / amounts, 0.0)
+    result = pd.DataFrame({
+        'name': grouped['name'],
+        'amount': amounts,
+        'weight': amounts / total,
+        'contribution': grouped['weighted'].to_numpy() / total,
+        'return': returns,
+    }, index=grouped.index, columns=GROUP_COLUMNS)
+    return result.sort_values('contribution', ascending=False)
+
+
+class AttributionEngine:
+    """
+    Portfolio-weighted return attribution for one holdings date
+
+    Holdings and child allocation rows are weighted by amount against the portfolio
+    total. Holding, account and allocation type contributions add up to the portfolio
+    return; sector and interest type only cover the holdings split into them.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def _load_gains(self, as_of: str, period: str) -> Tuple[Optional[str], pd.Series]:
+        """Per-ticker gains from the latest gain date on or before as_of"""
+        column = GAIN_COLUMNS.get(period)
+        if column:
+            rows = self.db.execute_query(
+                "SELECT MAX(assetdate) AS gaindate FROM assetgain WHERE assetdate <= %s", (as_of,))
+        else:
+            rows = self.db.execute_query(
+                "SELECT MAX(assetdate) AS gaindate FROM assetgainhorizon WHERE assetdate <= %s AND horizon=%s",
+                (as_of, period))
+        gain_date = rows[0]['gaindate'] if rows else None
+        if gain_date is None:
+            return None, pd.Series(dtype=np.float64)
+        gain_date = _day(gain_date)
+
+        if column:
+            rows = self.db.execute_query(
+                f"SELECT ticker, {column} AS gain FROM assetgain WHERE assetdate=%s", (gain_date,))
+        else:
+            rows = self.db.execute_query(
+                "SELECT ticker, gain, annualized FROM assetgainhorizon WHERE assetdate=%s AND horizon=%s",
+                (gain_date, period))
+            if any(row['annualized'] for row in rows):
+                print(f"Warning: {period} gains are annualized; contributions are approximate")
+
+        gains = pd.DataFrame(rows, columns=['ticker', 'gain'])
+        gains = gains.drop_duplicates('ticker', keep='last').set_index('ticker')['gain']
+        return gain_date, gains.astype(np.float64)
+
+    def load(self, as_of_date, period: str = '1m') -> Dict[str, object]:
+        """
+        Fetch holdings, child allocation rows, names and gains in one database session
+
+        Args:
+            as_of_date: Holdings from the latest asofdate on or before this date are used
+            period: assetgain period (1w, 2w, 1m, 3m, 6m, 1y) or an assetgainhorizon horizon
+
+        Returns:
+            Dict with holdings_date, gain_date, positions (DataFrame), children
+            ({dimension: DataFrame}), names ({dimension: {code: name}}) and gains (Series)
+        """
+        with self.db.session():
+            rows = self.db.execute_query(
+                "SELECT MAX(asofdate) AS asofdate FROM assetinv WHERE asofdate <= %s", (_day(as_of_date),))
+            holdings_date = rows[0]['asofdate'] if rows else None
+            if holdings_date is None:
+                raise Exception(f"No holdings on or before {_day(as_of_date)}")
+            holdings_date = _day(holdings_date)
+
+            positions = pd.DataFrame(self.db.execute_query("""
+                SELECT ai.assetinvid, ai.heldat, ai.amount, a.ticker
+                FROM assetinv ai
+                JOIN asset a ON a.assetid = ai.assetid
+                WHERE ai.asofdate = %s
+            """, (holdings_date,)), columns=['assetinvid', 'heldat', 'amount', 'ticker'])
+
+            children = {}
+            names = {}
+            for dimension, (table, code_column, name_query) in CHILD_DIMENSIONS.items():
+                children[dimension] = pd.DataFrame(self.db.execute_query(f"""
+                    SELECT c.assetinvid, c.{code_column} AS code, c.amount
+                    FROM {table} c
+                    JOIN assetinv ai ON ai.assetinvid = c.assetinvid
+                    WHERE ai.asofdate = %s
+                """, (holdings_date,)), columns=['assetinvid', 'code', 'amount'])
+                names[dimension] = {row['code']: row['name'] for row in self.db.execute_query(name_query)}
+
+            gain_date, gains = self._load_gains(holdings_date, period)
+
+        return {
+            'holdings_date': holdings_date,
+            'gain_date': gain_date,
+            'positions': positions,
+            'children': children,
+            'names': names,
+            'gains': gains,
+        }
+
+    def attribute(self, as_of_date, period: str = '1m') -> Dict[str, pd.DataFrame]:
+        """
+        Break the portfolio return for a period down by holding and dimension
+
+        Args:
+            as_of_date: Holdings date (the latest one on or before it is used)
+            period: Gain period, see load()
+
+        Returns:
+            {'holding': ..., 'account': ..., 'alloc': ..., 'sector': ..., 'inter': ...};
+            see group_contributions() for the columns. Holdings without a gain for the
+            period count as 0%. The holding frame's attrs carry holdings_date, gain_date,
+            period, total, portfolio_return and unpriced (holdings without a gain).
+        """
+        data = self.load(as_of_date, period)
+        positions = data['positions']
+        positions['amount'] = positions['amount'].astype(np.float64)
+        gains = data['gains']
+
+        position_gains = positions['ticker'].map(gains)
+        unpriced = int(position_gains.isna().sum())
+        positions['gain'] = position_gains.fillna(0.0).to_numpy(dtype=np.float64)
+        total = float(positions['amount'].sum())
+
+        positions['name'] = positions['ticker'] + ' (' + positions['heldat'] + ')'
+        results = {
+            'holding': group_contributions(positions, 'assetinvid', total),
+            'account': group_contributions(positions.assign(name=positions['heldat']), 'heldat', total),
+        }
+
+        # Child rows take the gain of the position they split
+        gain_by_position = pd.Series(positions['gain'].to_numpy(), index=positions['assetinvid'])
+        for dimension, rows in data['children'].items():
+            rows = rows.assign(
+                amount=rows['amount'].astype(np.float64),
+                gain=rows['assetinvid'].map(gain_by_position).fillna(0.0).to_numpy(dtype=np.float64),
+                name=rows['code'].map(data['names'][dimension]).fillna(rows['code'].astype(str)),
+            )
+            results[dimension] = group_contributions(rows, 'code', total)
+
+        contribution = float(results['account']['contribution'].sum()) if total else 0.0
+        results['holding'].attrs.update({
+            'holdings_date': data['holdings_date'],
+            'gain_date': data['gain_date'],
+            'period': period,
+            'total': total,
+            'portfolio_return': contribution,
+            'unpriced': unpriced,
+        })
+        return results
+
+    @staticmethod
+    def print_report(results: Dict[str, pd.DataFrame], top: int = 10):
+        """Print the attribution tables, limiting holdings to the top and bottom contributors"""
+        info = results['holding'].attrs
+        print(f"\n{'='*60}")
+        print(f"Return Attribution ({info['period']})")
+        print(f"{'='*60}")
+        print(f"Holdings date: {info['holdings_date']}   Gains date: {info['gain_date'] or 'none'}")
+        print(f"Portfolio: ${info['total']:,.2f}   Return: {info['portfolio_return']:+.2f}%")
+        if info['unpriced']:
+            print(f"Holdings without a {info['period']} gain (counted as 0%): {info['unpriced']}")
+
+        titles = [('account', 'By Account'), ('alloc', 'By Allocation Type'), ('sector', 'By Sector'),
+                  ('inter', 'By Interest Type'), ('holding', 'Top and Bottom Holdings')]
+        for key, title in titles:
+            frame = results[key]
+            if key == 'holding' and len(frame) > 2 * top:
+                frame = pd.concat([frame.head(top), frame.tail(top)])
+            print(f"\n{title}")
+            print(f"  {'Name':<30} {'Amount':>14} {'Weight':>8} {'Return':>8} {'Contrib':>8}")
+            print(f"  {'-'*72}")
+            for name, amount, weight, gain, contribution in zip(frame['name'], frame['amount'], frame['weight'],
+                                                                frame['return'], frame['contribution']):
+                print(f"  {str(name)[:30]:<30} {amount:>14,.2f} {weight * 100:>7.2f}% "
+                      f"{gain:>+7.2f}% {contribution:>+7.2f}%")
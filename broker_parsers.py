@@ -0,0 +1,443 @@
+"""
+Broker Export Parsers
+Registry of streaming parsers for the broker exports read by normalize_full_view. Each
+parser yields compact (account_prefix, ticker, amount) records, which PositionAggregator
+sums as they arrive, so memory stays flat however large an export is
+"""
+
+import csv
+import hashlib
+import inspect
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+Record = Tuple[str, str, float]
+
+# Registered parsers by name, in the order normalize_full_view reads them
+PARSERS: Dict[str, 'BrokerParser'] = {}
+
+
+def register_parser(parser_class):
+    """Class decorator adding a parser to the registry (replaces a parser of the same name)"""
+    parser = parser_class()
+    PARSERS[parser.name] = parser
+    return parser_class
+
+
+def parse_currency_value(value) -> Optional[float]:
+    """Convert currency-like strings to float, returning None when invalid"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    text = str(value).strip()
+    if text == '' or text == '-':
+        return None
+
+    # Handle accounting format like (1,234.56)
+    is_negative = text.startswith('(') and text.endswith(')')
+    cleaned = text.replace('$', '').replace(',', '').replace('%', '').strip('()').strip()
+
+    try:
+        amount = float(cleaned)
+        return -amount if is_negative else amount
+    except ValueError:
+        return None
+
+
+def file_digest(path: str) -> Optional[str]:
+    """SHA-256 of a file's contents, or None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parsers_fingerprint() -> str:
+    """
+    Hash of the registered parsers and the source of the modules defining them
+
+    Covers the account and symbol mappings as well as the parsing code, so it changes
+    whenever the same exports could normalize differently.
+    """
+    digest = hashlib.sha256()
+    for name, parser in PARSERS.items():
+        digest.update(f"{name}:{parser.filename}\n".encode())
+        digest.update(inspect.getsource(sys.modules[type(parser).__module__]).encode())
+    return digest.hexdigest()
+
+
+class BrokerParser:
+    """
+    One broker export format
+
+    Subclasses set name (the source_files key), filename (default file next to the
+    workbook) and implement records().
+    """
+
+    name = ''
+    filename = ''
+    required = False  # A missing or unreadable required export stops normalization
+
+    def records(self, path: str) -> Iterator[Record]:
+        """Yield (account_prefix, ticker, amount) for every position in the export"""
+        raise NotImplementedError
+
+
+@register_parser
+class FidelityParser(BrokerParser):
+    """Fidelity positions export (also holds the Vanguard accounts)"""
+
+    name = 'fidelity'
+    filename = 'Fidelity.csv'
+    required = True
+    chunk_rows = 50000
+
+    # Account mapping based on Account Name values
+    ACCOUNTS = {
+        'Individual - TOD': 'FidelityInv',
+        'Rollover IRA': 'FidelityIRA',
+        'Samir S Doshi - Brokerage Account - 10498558': 'Vanguard',
+        'Samir S Doshi - Rollover IRA': 'Vanguard IRA'
+    }
+
+    # Symbols that are cash positions (after trailing ** is stripped)
+    CASH_SYMBOLS = ['FDRXX', 'FCASH', 'Pending activity', 'VMRXX', 'VMFXX']
+
+    @classmethod
+    def normalize_symbol(cls, symbol) -> str:
+        """
+        Map a Fidelity symbol to the ticker used in account_ticker
+
+        Individual stocks keep Symbol='Stock' so they aggregate together; other symbols lose
+        trailing ** (e.g. FCASH** -> FCASH) and money market/pending entries become Cash.
+        Returns '' for a blank symbol.
+        """
+        symbol = str(symbol).strip()
+        if symbol == 'Stock':
+            return symbol
+        symbol = symbol.rstrip('*')
+        return 'Cash' if symbol in cls.CASH_SYMBOLS else symbol
+
+    @staticmethod
+    def parse_amounts(values: pd.Series) -> pd.Series:
+        """
+        Convert a column of amounts such as '$1,234.56' to floats
+
+        Returns:
+            Float Series with NaN where a value cannot be parsed
+        """
+        cleaned = values.astype(str).str.replace('$', '', regex=False).str.replace(',', '', regex=False)
+        # astype converts with float(), so amounts match per-row parsing exactly;
+        # to_numeric only finds the unparseable values (it can differ in the last digit)
+        try:
+            return cleaned.astype(np.float64)
+        except ValueError:
+            valid = pd.to_numeric(cleaned, errors='coerce').notna()
+            parsed = pd.Series(np.nan, index=values.index)
+            parsed[valid] = cleaned[valid].astype(np.float64)
+            return parsed
+
+    def records(self, path: str) -> Iterator[Record]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Fidelity.csv not found at {path}")
+
+        # Due to trailing commas, pandas uses the first column (Account Number) as the index
+        # and the remaining columns are shifted: column 0 holds Account Name, 1 Symbol,
+        # 2 Description and 6 Current Value
+        for chunk in pd.read_csv(path, dtype=str, chunksize=self.chunk_rows):
+            account_names = chunk.iloc[:, 0]
+            symbols = chunk.iloc[:, 1]
+            values = chunk.iloc[:, 6]
+
+            # Skip rows with any required field missing or empty. Names and symbols repeat,
+            # so they are cleaned once per distinct value and mapped back onto the column.
+            present = account_names.notna() & symbols.notna() & values.notna()
+            account_names = account_names[present]
+            prefixes = account_names.map({
+                name: self.ACCOUNTS.get(str(name).strip()) for name in account_names.unique()
+            })
+            symbols = symbols[present]
+            symbols = symbols.map({symbol: self.normalize_symbol(symbol) for symbol in symbols.unique()})
+            values = self.parse_amounts(values[present])
+
+            # Skip unparseable and zero values, and accounts not in the mapping (trow.csv covers those)
+            keep = (symbols != '') & values.notna() & (values != 0) & prefixes.notna()
+            yield from zip(prefixes[keep].tolist(), symbols[keep].tolist(), values[keep].tolist())
+
+
+@register_parser
+class TRowParser(BrokerParser):
+    """
+    T. Rowe Price holdings export
+
+    The CSV contains two sections:
+    1) Account holdings table with account type/ticker/market value.
+    2) Retirement plan table after a 'TRPRps' marker line where rows are name$amt.
+    """
+
+    name = 'trow'
+    filename = 'trow.csv'
+
+    ACCOUNTS = {
+        'Rollover IRA': 'TRPRollover',
+        'Individual': 'TRPInv',
+        'Roth IRA': 'TRPRoth',
+    }
+
+    RPS_FUNDS = {
+        'VANGUARD INST EXT MKT IDX D': 'VIIIX',
+        'VANGUARD INST 500 IDX TR D': 'VIEIX',
+        'TRP STABLE VALUE COMM TR FD-N': 'Cash',
+        'VANGUARD FTSE SOCIAL INDEX I': 'VFTNX',
+        'TRP US SMALL-CAP VALUE EQ TR-D': 'PRSVX',
+        'VANGUARD TTL INTL MKT IDX D': 'TRCEX',
+    }
+
+    def records(self, path: str) -> Iterator[Record]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Trow CSV file not found: {path}")
+
+        # Retirement plan lines are summed per fund (a handful of keys) and yielded at the end
+        rps_by_ticker = {}
+        in_rps_section = False
+        rps_pending_name = None
+
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            for raw_row in csv.reader(f):
+                row = [cell.strip() if cell is not None else '' for cell in raw_row]
+                if not row or all(cell == '' for cell in row):
+                    continue
+
+                # Detect second section marker: TRPRps
+                if row[0].lower() == 'trprps':
+                    in_rps_section = True
+                    continue
+
+                # Backward compatibility with older second-table header.
+                if len(row) >= 2 and row[0].lower() == 'investment name' and row[1].lower() == 'amount':
+                    in_rps_section = True
+                    continue
+
+                if in_rps_section:
+                    # Amounts include commas and are unquoted in trow.csv, so csv.reader
+                    # may split a single logical row into multiple columns.
+                    line = ','.join(row).strip()
+
+                    # Format 1: alternating lines — fund name on one line, amount on next.
+                    # Format 2: single line in the form: Investment Name$123,456.78
+                    if '$' not in line:
+                        # This is a fund name line; hold it for the next amount line.
+                        rps_pending_name = line
+                        continue
+
+                    # Line contains '$' — could be a standalone amount line or name$amount.
+                    if line.startswith('$') and rps_pending_name is not None:
+                        # Alternating format: amount line following a name line.
+                        inv_name = rps_pending_name
+                        amount = parse_currency_value(line)
+                        rps_pending_name = None
+                    else:
+                        # Single-line format: Investment Name$123,456.78
+                        rps_pending_name = None
+                        inv_name, amt_part = line.rsplit('$', 1)
+                        inv_name = inv_name.strip()
+                        amount = parse_currency_value(f'${amt_part.strip()}')
+
+                    if amount is None or amount == 0:
+                        continue
+
+                    mapped_ticker = self.RPS_FUNDS.get(inv_name)
+                    if mapped_ticker:
+                        rps_by_ticker[mapped_ticker] = rps_by_ticker.get(mapped_ticker, 0.0) + amount
+                    elif inv_name.upper().startswith('TRP RETIREMENT BLEND'):
+                        rps_by_ticker['TRRIX'] = rps_by_ticker.get('TRRIX', 0.0) + amount
+                    continue
+
+                # Skip the first section header row.
+                if row[0].lower() == 'category':
+                    continue
+
+                if len(row) < 10:
+                    continue
+
+                account_prefix = self.ACCOUNTS.get(row[1])
+                if not account_prefix:
+                    continue
+
+                # Match existing Trow behavior: skip blank ticker and zero/empty value.
+                ticker = row[3]
+                market_value = parse_currency_value(row[9])
+                if ticker == '' or market_value is None or market_value == 0:
+                    continue
+
+                yield account_prefix, ticker, market_value
+
+        for ticker, total_amount in rps_by_ticker.items():
+            if total_amount != 0:
+                yield 'TRPRps', ticker, total_amount
+
+
+@register_parser
+class StocksParser(BrokerParser):
+    """
+    Stock account balances: tab-delimited, no header, with account name, category
+    (Stock, Cash, Total) and value columns. Yields Cash and Stock = Total - Cash.
+    """
+
+    name = 'stocks'
+    filename = 'stocks.csv'
+
+    def records(self, path: str) -> Iterator[Record]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Stocks CSV file not found: {path}")
+
+        accounts = {}  # {account_name: {Stock, Cash, Total}}, one entry per account
+
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            for raw_row in csv.reader(f, delimiter='\t'):
+                row = [cell.strip() if cell is not None else '' for cell in raw_row]
+
+                # Skip empty rows and rows with insufficient columns
+                if len(row) < 3 or all(cell == '' for cell in row):
+                    continue
+
+                account_name = row[0]
+                category = row[1]
+                if not account_name or not category:
+                    continue
+
+                try:
+                    value = float(row[2])
+                except ValueError:
+                    continue
+
+                if account_name not in accounts:
+                    accounts[account_name] = {'Stock': None, 'Cash': None, 'Total': None}
+                if category in accounts[account_name]:
+                    accounts[account_name][category] = value
+
+        for account_name, values in accounts.items():
+            total = values.get('Total')
+            cash = values.get('Cash')
+
+            # Skip if we don't have Total and Cash values
+            if total is None or cash is None:
+                continue
+
+            if cash != 0:
+                yield account_name, 'Cash', cash
+
+            stock_value = total - cash
+            if stock_value != 0:
+                yield account_name, 'Stock', stock_value
+
+
+class PositionAggregator:
+    """Running totals per (account_prefix, ticker) and per account, kept in first-seen order"""
+
+    def __init__(self):
+        self.amounts: Dict[Tuple[str, str], float] = {}
+        self.accounts: Dict[str, float] = {}
+
+    def add(self, records: Iterable[Record]) -> int:
+        """Add records as they stream in; returns how many were added"""
+        amounts = self.amounts
+        accounts = self.accounts
+        count = 0
+        for account_prefix, ticker, amount in records:
+            key = (account_prefix, ticker)
+            amounts[key] = amounts.get(key, 0) + amount
+            accounts[account_prefix] = accounts.get(account_prefix, 0) + amount
+            count += 1
+        return count
+
+    @classmethod
+    def combine(cls, parts: Iterable['PositionAggregator']) -> 'PositionAggregator':
+        """Merge per-export totals in one pass, in the order given"""
+        combined = cls()
+        amounts = combined.amounts
+        accounts = combined.accounts
+        for part in parts:
+            for key, amount in part.amounts.items():
+                amounts[key] = amounts.get(key, 0) + amount
+            for account_prefix, amount in part.accounts.items():
+                accounts[account_prefix] = accounts.get(account_prefix, 0) + amount
+        return combined
+
+    def _sorted(self) -> pd.DataFrame:
+        """Non-zero totals with both key forms, sorted by account_ticker"""
+        keys = list(self.amounts)
+        frame = pd.DataFrame({
+            'account_ticker': [f"{account_prefix}_{ticker}" for account_prefix, ticker in keys],
+            'amount': list(self.amounts.values()),
+            'HeldAt': [account_prefix for account_prefix, _ in keys],
+            'Ticker': [ticker for _, ticker in keys],
+        })
+        frame = frame[frame['amount'] != 0]
+        return frame.sort_values(by='account_ticker', ascending=True)
+
+    def positions(self) -> pd.DataFrame:
+        """account_ticker/amount rows sorted by account_ticker, without zero totals (allaccounts.csv)"""
+        return self._sorted()[['account_ticker', 'amount']]
+
+    def allocation_input(self) -> pd.DataFrame:
+        """
+        The same rows as positions() in the Ticker/Amount/HeldAt layout read by
+        process_asset_allocation, taken from the stored keys instead of splitting
+        account_ticker strings
+        """
+        frame = self._sorted()
+        return pd.DataFrame({
+            'Ticker': frame['Ticker'].to_numpy(),
+            'Amount': frame['amount'].to_numpy(dtype=np.float64),
+            'HeldAt': frame['HeldAt'].to_numpy(),
+        })
+
+    def summary(self) -> pd.DataFrame:
+        """account/total rows in first-seen order"""
+        return pd.DataFrame(list(self.accounts.items()), columns=['account', 'total'])
+
+
+def parse_export(parser: BrokerParser, path: str) -> Tuple[PositionAggregator, int, float]:
+    """Aggregate one export: (totals, records read, seconds taken)"""
+    started = time.perf_counter()
+    totals = PositionAggregator()
+    count = totals.add(parser.records(path))
+    return totals, count, time.perf_counter() - started
+
+
+def parse_exports(paths: Dict[str, str], max_workers: Optional[int] = None) -> Dict[str, tuple]:
+    """
+    Parse several exports concurrently, each in its own worker thread
+
+    A failing export does not stop or delay the others.
+
+    Args:
+        paths: {parser name: export path}
+        max_workers: Worker threads (default: one per export)
+
+    Returns:
+        {name: (totals or None, records read, seconds taken, exception or None)}, in
+        the order of paths
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(paths), 1)) as executor:
+        started = time.perf_counter()
+        futures = {name: executor.submit(parse_export, PARSERS[name], path) for name, path in paths.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result() + (None,)
+            except Exception as e:
+                results[name] = (None, 0, time.perf_counter() - started, e)
+    return results
@@ -0,0 +1,174 @@
+"""
+Price Fixture Server
+Serves recorded daily-history CSVs over HTTP with configurable latency, so gain
+fetching can be run and load tested without internet access
+
+Usage:
+    python fixture_server.py fixtures --port 8765 --latency 0.2
+    python fixture_server.py fixtures --record FXAIX VTSAX --days 400
+    python fixture_server.py fixtures --synthesize 60 --days 400
+
+Then run gains against it with:
+    python process_assets.py --gains-only --price-source http://localhost:8765
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from price_providers import YahooProvider
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files from the fixture directory after an artificial delay"""
+
+    latency = 0.0
+    jitter = 0.0
+    requests_served = 0
+    _count_lock = threading.Lock()
+
+    def do_GET(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with self._count_lock:
+            FixtureRequestHandler.requests_served += 1
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        # One line per request would swamp the output during load tests
+        pass
+
+
+def write_history_csv(path: str, prices: Dict[str, float]):
+    """Write closes in the Yahoo daily history layout read by FixtureProvider"""
+    with open(path, 'w') as f:
+        f.write("Date,Open,High,Low,Close,Adj Close,Volume\n")
+        for day in sorted(prices):
+            close = prices[day]
+            f.write(f"{day},{close},{close},{close},{close},{close},0\n")
+
+
+def record_fixtures(directory: str, tickers: List[str], days: int = 400) -> int:
+    """
+    Download history from Yahoo and save it as fixtures
+
+    Args:
+        directory: Fixture directory
+        tickers: Tickers to record
+        days: Calendar days of history up to today
+
+    Returns:
+        Number of tickers recorded
+    """
+    os.makedirs(directory, exist_ok=True)
+    provider = YahooProvider()
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=days)
+    recorded = 0
+    for ticker in tickers:
+        prices = provider.fetch_prices(ticker, start_date, end_date)
+        if not prices:
+            print(f"No history recorded for {ticker}")
+            continue
+        write_history_csv(os.path.join(directory, f"{ticker}.csv"), prices)
+        recorded += 1
+        print(f"Recorded {len(prices)} closes for {ticker}")
+    return recorded
+
+
+def synthesize_fixtures(directory: str, count: int, days: int = 400, seed: int = 0) -> List[str]:
+    """
+    Generate random-walk histories for load tests
+
+    Args:
+        directory: Fixture directory
+        count: Number of tickers (named FIX000, FIX001, ...)
+        days: Calendar days of history up to today
+        seed: Random seed, so runs are repeatable
+
+    Returns:
+        Generated ticker names
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    end_date = datetime.now()
+    tickers = []
+    for n in range(count):
+        ticker = f"FIX{n:03d}"
+        close = rng.uniform(20, 500)
+        prices = {}
+        for offset in range(days, -1, -1):
+            day = end_date - timedelta(days=offset)
+            if day.weekday() < 5:
+                close = max(1.0, close * (1 + rng.gauss(0.0003, 0.01)))
+                prices[day.strftime('%Y-%m-%d')] = round(close, 2)
+        write_history_csv(os.path.join(directory, f"{ticker}.csv"), prices)
+        tickers.append(ticker)
+    print(f"Generated {count} fixture histories in {directory}")
+    return tickers
+
+
+def serve(directory: str, host: str = '127.0.0.1', port: int = 8765,
+          latency: float = 0.0, jitter: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Create a threaded fixture server (call serve_forever() or run it in a thread)
+
+    Args:
+        directory: Directory holding <TICKER>.csv fixtures
+        host: Interface to bind
+        port: Port to listen on (0 picks a free port)
+        latency: Seconds added to every response
+        jitter: Up to this many extra random seconds per response
+
+    Returns:
+        The server; its address is server.server_address
+    """
+    handler = type('Handler', (FixtureRequestHandler,), {'latency': latency, 'jitter': jitter})
+
+    def make_handler(*args, **kwargs):
+        return handler(*args, directory=directory, **kwargs)
+
+    return ThreadingHTTPServer((host, port), make_handler)
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Serve recorded price histories for offline gain runs')
+    parser.add_argument('directory', help='Fixture directory with <TICKER>.csv files')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to bind (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default: 8765)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of delay per response (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra random delay up to this many seconds')
+    parser.add_argument('--record', nargs='+', metavar='TICKER', help='Download these tickers from Yahoo and exit')
+    parser.add_argument('--synthesize', type=int, metavar='COUNT', help='Generate COUNT random-walk histories and exit')
+    parser.add_argument('--days', type=int, default=400, help='Days of history to record or generate (default: 400)')
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    if args.record:
+        record_fixtures(args.directory, args.record, args.days)
+        return
+    if args.synthesize:
+        synthesize_fixtures(args.directory, args.synthesize, args.days)
+        return
+
+    server = serve(args.directory, args.host, args.port, args.latency, args.jitter)
+    print(f"Serving fixtures from {args.directory} on http://{args.host}:{server.server_address[1]} "
+          f"(latency {args.latency}s, jitter {args.jitter}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {FixtureRequestHandler.requests_served} requests")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Gains Matrix
+Aligns daily closes of many tickers into one date x ticker matrix and computes every
+lookback return for all tickers in one vectorized pass
+"""
+
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+def price_matrix(prices_by_ticker: Dict[str, Dict[str, float]]) -> pd.DataFrame:
+    """
+    Align closes into a date x ticker matrix
+
+    Args:
+        prices_by_ticker: {ticker: {'YYYY-MM-DD': close}}
+
+    Returns:
+        DataFrame indexed by date (ascending) with one column per ticker; NaN where a
+        ticker has no close for a date
+    """
+    matrix = pd.DataFrame(
+        {ticker: pd.Series(prices, dtype=np.float64) for ticker, prices in prices_by_ticker.items()},
+        columns=list(prices_by_ticker)
+    )
+    matrix.index = pd.to_datetime(matrix.index)
+    return matrix.sort_index()
+
+
+def asof_prices(matrix: pd.DataFrame, dates: List) -> np.ndarray:
+    """
+    Close on or before each date for every ticker
+
+    Args:
+        matrix: Output of price_matrix
+        dates: Lookup dates
+
+    Returns:
+        len(dates) x tickers array; NaN where a ticker has no close on or before the date
+    """
+    if matrix.empty:
+        return np.full((len(dates), len(matrix.columns)), np.nan)
+
+    # Carry each ticker's last close forward, then take the last row at or before each date
+    filled = matrix.ffill().to_numpy()
+    days = matrix.index.to_numpy(dtype='datetime64[ns]')
+    targets = pd.to_datetime([pd.Timestamp(dt).normalize() for dt in dates]).to_numpy(dtype='datetime64[ns]')
+    rows = np.searchsorted(days, targets, side='right') - 1
+
+    result = filled[np.clip(rows, 0, None)]
+    result[rows < 0] = np.nan
+    return result
+
+
+def lookback_gains(prices_by_ticker: Dict[str, Dict[str, float]], dates: List) -> Dict[str, List[float]]:
+    """
+    Percent change from each lookback date to dates[0] for every ticker
+
+    Args:
+        prices_by_ticker: {ticker: {'YYYY-MM-DD': close}}
+        dates: As-of date followed by the lookback dates
+
+    Returns:
+        {ticker: gains} where gains[0] is 0 and gains[i] is the return since dates[i],
+        rounded to 2 decimals; 0 where either close is missing or zero
+    """
+    if not prices_by_ticker:
+        return {}
+
+    prices = asof_prices(price_matrix(prices_by_ticker), dates)
+    current = prices[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gains = np.round((current - prices) / prices * 100, 2)
+    valid = (current != 0) & ~np.isnan(current) & (prices != 0) & ~np.isnan(prices)
+    gains = np.where(valid, gains, 0.0)
+    gains[0] = 0.0
+
+    return {ticker: gains[:, k].tolist() for k, ticker in enumerate(prices_by_ticker)}
+
+
+# Horizon name -> (kind, count); the first six are the assetgain columns
+HORIZONS = {
+    '1w': ('weeks', 1),
+    '2w': ('weeks', 2),
+    '1m': ('weeks', 4),
+    '3m': ('weeks', 12),
+    '6m': ('weeks', 24),
+    '1y': ('weeks', 52),
+    'ytd': ('ytd', 0),
+    '3y': ('years', 3),
+    '5y': ('years', 5),
+    '10y': ('years', 10),
+    'inception': ('inception', 0),
+}
+
+# Returned as compound annual rates when the span is at least a year
+ANNUALIZED_HORIZONS = {'3y', '5y', '10y', 'inception'}
+
+
+def horizon_returns(prices_by_ticker: Dict[str, Dict[str, float]], as_of, starts: Dict[str, object]) -> pd.DataFrame:
+    """
+    Returns over several horizons for every ticker in one vectorized pass
+
+    Args:
+        prices_by_ticker: {ticker: {'YYYY-MM-DD': close}}
+        as_of: End date of every horizon
+        starts: {horizon: start date}, with None meaning each ticker's first close
+            (since inception)
+
+    Returns:
+        Long-format DataFrame with columns ticker, horizon, startdate, gain (percent,
+        rounded to 2 decimals) and annualized; tickers whose history does not reach
+        back to a horizon's start are left out of that horizon
+    """
+    columns = ['ticker', 'horizon', 'startdate', 'gain', 'annualized']
+    matrix = price_matrix(prices_by_ticker)
+    if matrix.empty or not starts:
+        return pd.DataFrame(columns=columns)
+
+    tickers = np.array(matrix.columns, dtype=object)
+    horizons = list(starts)
+    fixed = [horizon for horizon in horizons if starts[horizon] is not None]
+
+    # Row 0 is the as-of close, then one row per fixed start date
+    prices = asof_prices(matrix, [as_of] + [starts[horizon] for horizon in fixed])
+    current = prices[0]
+    start_prices = {horizon: prices[k + 1] for k, horizon in enumerate(fixed)}
+    end_day = pd.Timestamp(as_of).normalize().to_datetime64()
+    start_days = {
+        horizon: np.full(len(tickers), pd.Timestamp(starts[horizon]).normalize().to_datetime64())
+        for horizon in fixed
+    }
+
+    if len(fixed) < len(horizons):
+        # First close of each ticker for the since-inception horizon
+        values = matrix.to_numpy()
+        valid = ~np.isnan(values)
+        first = valid.argmax(axis=0)
+        inception_prices = values[first, np.arange(len(tickers))]
+        inception_prices[~valid.any(axis=0)] = np.nan
+        inception_days = matrix.index.to_numpy(dtype='datetime64[ns]')[first]
+        for horizon in horizons:
+            if starts[horizon] is None:
+                start_prices[horizon] = inception_prices
+                start_days[horizon] = inception_days
+
+    begin = np.vstack([start_prices[horizon] for horizon in horizons])
+    begin_days = np.vstack([start_days[horizon] for horizon in horizons])
+    years = (end_day - begin_days) / np.timedelta64(1, 'D') / 365.25
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cumulative = current / begin - 1
+        annualize = np.array([horizon in ANNUALIZED_HORIZONS for horizon in horizons])[:, None] & (years >= 1)
+        rates = np.where(annualize, np.power(1 + cumulative, 1 / np.where(years > 0, years, 1)) - 1, cumulative)
+    gains = np.round(rates * 100, 2)
+    valid = ~np.isnan(gains) & (begin > 0) & (current > 0)
+
+    rows, cols = np.nonzero(valid)
+    return pd.DataFrame({
+        'ticker': tickers[cols],
+        'horizon': np.array(horizons, dtype=object)[rows],
+        'startdate': pd.to_datetime(begin_days[rows, cols]).strftime('%Y-%m-%d'),
+        'gain': gains[rows, cols],
+        'annualized': annualize[rows, cols],
+    }, columns=columns)
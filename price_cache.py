@@ -0,0 +1,185 @@
+"""
+Price History Cache
+Keeps daily closes per ticker in a local SQLite file so gain runs only download
+the days that are not stored yet, plus the day's raw provider responses
+"""
+
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class PriceCache:
+    """
+    On-disk store of daily closes keyed by (ticker, date)
+
+    fetch_state records the date range already requested for each ticker, so
+    missing_ranges() can tell which part of a lookback window still needs fetching.
+    Safe to share between fetch threads.
+    """
+
+    def __init__(self, path: str = 'price_cache.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None  # Opened on first use so runs without gains never create the file
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute("""
+                    CREATE TABLE IF NOT EXISTS prices (
+                        ticker TEXT NOT NULL,
+                        pricedate TEXT NOT NULL,
+                        close REAL NOT NULL,
+                        PRIMARY KEY (ticker, pricedate)
+                    )
+                """)
+                self._db.execute("""
+                    CREATE TABLE IF NOT EXISTS fetch_state (
+                        ticker TEXT PRIMARY KEY,
+                        first_date TEXT NOT NULL,
+                        last_date TEXT NOT NULL,
+                        fetched_at TEXT NOT NULL
+                    )
+                """)
+                self._db.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        source TEXT NOT NULL,
+                        ticker TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        body TEXT NOT NULL,
+                        PRIMARY KEY (source, ticker, day)
+                    )
+                """)
+        return self._db
+
+    @staticmethod
+    def _day(dt) -> str:
+        return dt if isinstance(dt, str) else dt.strftime('%Y-%m-%d')
+
+    def fetched_range(self, ticker: str) -> Optional[Tuple[str, str]]:
+        """(first_date, last_date) already covered for the ticker, or None if never fetched"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT first_date, last_date FROM fetch_state WHERE ticker=?", (ticker,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def missing_ranges(self, ticker: str, start: datetime, end: datetime) -> list:
+        """
+        Date ranges within [start, end] that have not been fetched yet
+
+        Args:
+            ticker: Ticker symbol
+            start: First date needed
+            end: Last date needed
+
+        Returns:
+            List of (start, end) datetime pairs, empty when the cache covers the window
+        """
+        covered = self.fetched_range(ticker)
+        if covered is None:
+            return [(start, end)]
+
+        first, last = (datetime.strptime(day, '%Y-%m-%d') for day in covered)
+        ranges = []
+        if start < first:
+            ranges.append((start, min(end, first - timedelta(days=1))))
+        if end > last:
+            ranges.append((max(start, last + timedelta(days=1)), end))
+        return ranges
+
+    def store(self, ticker: str, prices: Dict[str, float], start: datetime, end: datetime):
+        """
+        Save fetched closes and extend the ticker's fetched range
+
+        The range only extends to the latest date that actually returned a price, so
+        days the provider had not published yet are requested again next time.
+
+        Args:
+            ticker: Ticker symbol
+            prices: {'YYYY-MM-DD': close}
+            start: First date that was requested
+            end: Last date that was requested
+        """
+        first = self._day(start)
+        last = max((day for day in prices if day <= self._day(end)), default=None)
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO prices(ticker, pricedate, close) VALUES (?, ?, ?)",
+                [(ticker, day, close) for day, close in prices.items()]
+            )
+            row = self._conn.execute(
+                "SELECT first_date, last_date FROM fetch_state WHERE ticker=?", (ticker,)
+            ).fetchone()
+            if row is None:
+                if last is None:
+                    return
+                new_first, new_last = first, last
+            else:
+                new_first = min(row[0], first)
+                new_last = max(row[1], last) if last is not None else row[1]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fetch_state(ticker, first_date, last_date, fetched_at) VALUES (?, ?, ?, ?)",
+                (ticker, new_first, new_last, datetime.now().isoformat(timespec='seconds'))
+            )
+
+    def history(self, ticker: str, start, end) -> Dict[str, float]:
+        """All cached closes from start through end as {'YYYY-MM-DD': close}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT pricedate, close FROM prices WHERE ticker=? AND pricedate BETWEEN ? AND ? ORDER BY pricedate",
+                (ticker, self._day(start), self._day(end))
+            ).fetchall()
+        return dict(rows)
+
+    def histories(self, tickers: Iterable[str], start, end) -> Dict[str, Dict[str, float]]:
+        """Cached closes of many tickers from start through end as {ticker: {'YYYY-MM-DD': close}}, in one query"""
+        tickers = list(tickers)
+        if not tickers:
+            return {}
+        placeholders = ', '.join(['?'] * len(tickers))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT ticker, pricedate, close FROM prices WHERE ticker IN ({placeholders}) "
+                "AND pricedate BETWEEN ? AND ? ORDER BY pricedate",
+                tickers + [self._day(start), self._day(end)]
+            ).fetchall()
+        histories = {}
+        for ticker, day, close in rows:
+            histories.setdefault(ticker, {})[day] = close
+        return histories
+
+    def get_response(self, source: str, ticker: str, day) -> Optional[str]:
+        """Raw response body saved for the source, ticker and day, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM responses WHERE source=? AND ticker=? AND day=?",
+                (source, ticker, self._day(day))
+            ).fetchone()
+        return row[0] if row else None
+
+    def store_response(self, source: str, ticker: str, day, body: str):
+        """Save a raw response body, replacing older days for the same source and ticker"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses WHERE source=? AND ticker=? AND day<?",
+                               (source, ticker, self._day(day)))
+            self._conn.execute("INSERT OR REPLACE INTO responses(source, ticker, day, body) VALUES (?, ?, ?, ?)",
+                               (source, ticker, self._day(day), body))
+
+    def invalidate(self, ticker: str):
+        """Drop a ticker's history so the next fetch downloads it again"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM prices WHERE ticker=?", (ticker,))
+            self._conn.execute("DELETE FROM fetch_state WHERE ticker=?", (ticker,))
+            self._conn.execute("DELETE FROM responses WHERE ticker=?", (ticker,))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,543 @@
+"""
+Price Providers
+Pluggable sources of benchmark prices and returns for GainCalculator, with a
+fallback chain that remembers which provider worked for each ticker
+"""
+
+import csv
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from io import StringIO
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from lxml import html as lxml_html
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while a provider's circuit breaker is open"""
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until it is available; returns the seconds waited"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now (possibly going negative) so waiters queue fairly
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after repeated failures
+
+    Opens after `failure_threshold` consecutive failures; after `reset_timeout`
+    seconds one trial request is let through (half-open) and its outcome closes or
+    reopens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True if a request may be sent now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns True if this failure opened the breaker"""
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class FetchMetrics:
+    """Per-provider counters for one run: requests, retries, throttling and breaker activity"""
+
+    COUNTERS = ('requests', 'retries', 'throttled', 'failures', 'breaker_opened', 'short_circuited')
+    TIMERS = ('rate_wait', 'backoff_wait')  # Seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+    def add(self, provider: str, name: str, amount: float = 1):
+        with self._lock:
+            provider_values = self.values.setdefault(provider, dict.fromkeys(self.COUNTERS + self.TIMERS, 0))
+            provider_values[name] += amount
+
+    def report(self):
+        """Print one line per provider that was used this run"""
+        with self._lock:
+            values = {provider: dict(counts) for provider, counts in self.values.items()}
+        for provider, counts in sorted(values.items()):
+            counters = ", ".join(f"{name}={counts[name]}" for name in self.COUNTERS)
+            lost = counts['rate_wait'] + counts['backoff_wait']
+            print(f"  {provider}: {counters}, time lost to throttling {lost:.1f}s "
+                  f"(rate limit {counts['rate_wait']:.1f}s, backoff {counts['backoff_wait']:.1f}s)")
+
+
+class PriceFetcher:
+    """Thread-safe HTTP fetcher for price providers
+
+    Each worker thread reuses its own requests.Session (keep-alive connections), every
+    provider has its own timeout and concurrent requests per host are capped. Requests
+    are paced by a token bucket per provider, throttled or failed requests are retried
+    with exponential backoff and full jitter, and a circuit breaker per provider makes
+    get() fail fast (CircuitOpenError) once the provider keeps failing.
+    """
+
+    PROVIDER_TIMEOUTS = {'yahoo': 15, 'morningstar': 10, 'fixture': 5}  # Seconds
+    DEFAULT_TIMEOUT = 15
+    # (requests per second, burst); providers not listed are not rate limited
+    PROVIDER_RATES = {'yahoo': (2.0, 5), 'morningstar': (2.0, 5)}
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, per_host_limit: int = 4, timeouts: Optional[Dict[str, float]] = None,
+                 rates: Optional[Dict[str, tuple]] = None, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.per_host_limit = per_host_limit
+        self.timeouts = dict(self.PROVIDER_TIMEOUTS, **(timeouts or {}))
+        self.rates = dict(self.PROVIDER_RATES, **(rates or {}))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = FetchMetrics()
+        self._local = threading.local()
+        self._host_slots = {}
+        self._buckets = {}
+        self._breakers = {}
+        self._host_lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        """requests.Session owned by the calling thread"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _slots(self, url: str) -> threading.BoundedSemaphore:
+        """Semaphore limiting concurrent requests to the URL's host"""
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+
+    def _bucket(self, provider: str) -> Optional[TokenBucket]:
+        if self.rates.get(provider) is None:
+            return None
+        with self._host_lock:
+            if provider not in self._buckets:
+                self._buckets[provider] = TokenBucket(*self.rates[provider])
+            return self._buckets[provider]
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        """Circuit breaker of a provider"""
+        with self._host_lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[provider]
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response]) -> float:
+        """Exponential backoff with full jitter, honouring a numeric Retry-After header"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.backoff_max, float(retry_after)))
+        return delay
+
+    def get(self, provider: str, url: str, **kwargs) -> requests.Response:
+        """
+        GET url with the provider's timeout, rate limit, retries and circuit breaker
+
+        Args:
+            provider: Provider name (selects timeout, rate limit and breaker)
+            url: URL to fetch
+
+        Returns:
+            The final response (which may still be an error status once retries run out)
+
+        Raises:
+            CircuitOpenError: If the provider's breaker is open
+            requests.RequestException: If the last attempt failed without a response
+        """
+        breaker = self.breaker(provider)
+        bucket = self._bucket(provider)
+        timeout = self.timeouts.get(provider, self.DEFAULT_TIMEOUT)
+
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                self.metrics.add(provider, 'short_circuited')
+                raise CircuitOpenError(f"{provider} circuit breaker is open")
+            if bucket is not None:
+                self.metrics.add(provider, 'rate_wait', bucket.acquire())
+
+            response, error = None, None
+            self.metrics.add(provider, 'requests')
+            try:
+                with self._slots(url):
+                    response = self._session().get(url, timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+
+            if error is None and response.status_code not in self.RETRY_STATUSES:
+                breaker.record_success()
+                return response
+
+            if response is not None and response.status_code == 429:
+                self.metrics.add(provider, 'throttled')
+            self.metrics.add(provider, 'failures')
+            if breaker.record_failure():
+                self.metrics.add(provider, 'breaker_opened')
+                print(f"Circuit breaker opened for {provider}; remaining tickers fall back")
+
+            if attempt == self.max_retries or breaker.state == 'open':
+                break
+            delay = self._backoff(attempt, response)
+            self.metrics.add(provider, 'retries')
+            self.metrics.add(provider, 'backoff_wait', delay)
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+
+def parse_history_csv(text: str, start_date: datetime = None, end_date: datetime = None) -> Dict[str, float]:
+    """
+    Parse Yahoo-style daily history CSV (Date, ..., Close) into closes
+
+    Args:
+        text: CSV text with a header row
+        start_date: Optional first date to keep
+        end_date: Optional last date to keep
+
+    Returns:
+        {'YYYY-MM-DD': close}
+    """
+    first = start_date.strftime('%Y-%m-%d') if start_date else ''
+    last = end_date.strftime('%Y-%m-%d') if end_date else '9999-12-31'
+    prices = {}
+    for row in csv.DictReader(StringIO(text)):
+        if first <= row['Date'] <= last and row['Close'] not in ('', 'null'):
+            prices[row['Date']] = float(row['Close'])
+    return prices
+
+
+class PriceProvider:
+    """
+    Base class for price sources
+
+    Providers of kind 'prices' implement fetch_prices() and return daily closes;
+    providers of kind 'gains' implement fetch_gains() and return lookback returns
+    directly. Both return None when they have nothing for the ticker.
+    """
+
+    name = ''
+    kind = 'prices'
+
+    def __init__(self, fetcher: Optional[PriceFetcher] = None):
+        self.fetcher = fetcher or PriceFetcher()
+
+    def fetch_prices(self, ticker: str, start_date: datetime, end_date: datetime) -> Optional[Dict[str, float]]:
+        """Daily closes from start_date up to (not including) end_date as {'YYYY-MM-DD': close}"""
+        return None
+
+    def fetch_gains(self, ticker: str, dates: List[datetime]) -> Optional[List[float]]:
+        """Percent returns since each of dates[1:], with gains[0] = 0"""
+        return None
+
+
+class YahooProvider(PriceProvider):
+    """Daily history CSV from Yahoo Finance"""
+
+    name = 'yahoo'
+
+    @staticmethod
+    def url(ticker: str, start_date: datetime, end_date: datetime) -> str:
+        """Yahoo Finance daily history CSV URL for a date range"""
+        return (f"https://query1.finance.yahoo.com/v7/finance/download/{ticker}"
+                f"?period1={int(start_date.timestamp())}"
+                f"&period2={int(end_date.timestamp())}"
+                f"&interval=1d&events=history")
+
+    def fetch_prices(self, ticker: str, start_date: datetime, end_date: datetime) -> Optional[Dict[str, float]]:
+        if ticker == 'FCASH':
+            return None
+
+        try:
+            response = self.fetcher.get(self.name, self.url(ticker, start_date, end_date))
+            if response.status_code != 200:
+                print(f"Failed to fetch data for {ticker}")
+                return None
+            return parse_history_csv(response.text)
+
+        except CircuitOpenError:
+            # Provider is failing; let the chain fall back without another request
+            return None
+        except Exception as e:
+            print(f"Error fetching Yahoo prices for {ticker}: {e}")
+            return None
+
+
+def _percent(text: str) -> Optional[float]:
+    """Parse a return cell such as '1.23', '-0.45%' or an em dash (no value)"""
+    text = text.replace('%', '').replace(',', '').replace('\u2014', '').replace('\u2013', '').strip()
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def parse_trailing_returns(text: str) -> Dict[str, Optional[float]]:
+    """
+    Extract the fund's row of Morningstar's trailing total returns table
+
+    Args:
+        text: HTML of the trailing-total-returns page
+
+    Returns:
+        {period label: percent} such as {'1-Day': 0.12, '1-Week': -0.8, ...};
+        empty if the page has no returns table
+    """
+    if not text or not text.strip():
+        return {}
+    try:
+        tree = lxml_html.fromstring(text)
+    except Exception:
+        return {}
+
+    rows = tree.xpath('//tr')
+    for i, row in enumerate(rows):
+        labels = [cell.text_content().strip() for cell in row.xpath('./th|./td')]
+        if '1-Day' not in labels:
+            continue
+
+        # The first row after the header is the fund itself (the rest are benchmarks)
+        for data_row in rows[i + 1:]:
+            cells = [cell.text_content().strip() for cell in data_row.xpath('./th|./td')]
+            if len(cells) < len(labels) or not any(_percent(cell) is not None for cell in cells):
+                continue
+            # Align from the right so a leading name column without a header still lines up
+            values = cells[len(cells) - len(labels):]
+            return {label: _percent(value) for label, value in zip(labels, values) if label}
+        return {}
+    return {}
+
+
+class MorningstarProvider(PriceProvider):
+    """
+    Trailing total returns from Morningstar
+
+    The page only has returns as of the latest close, so gains are only returned when
+    dates[0] is the latest trading day; runs for past dates fall through to the
+    price-based providers.
+    """
+
+    name = 'morningstar'
+    kind = 'gains'
+
+    # Trailing-return period -> index in the lookback gains list
+    # (0 is the as-of date; 2 weeks and 6 months have no Morningstar column and stay 0)
+    PERIOD_COLUMNS = {'1-Week': 1, '1-Month': 3, '3-Month': 4, '1-Year': 6}
+
+    def __init__(self, fetcher: Optional[PriceFetcher] = None, response_cache=None):
+        super().__init__(fetcher)
+        self.response_cache = response_cache  # PriceCache; raw pages are kept per ticker and day
+
+    @staticmethod
+    def url(ticker: str) -> str:
+        return f"https://performance.morningstar.com/Performance/fund/trailing-total-returns.action?t={ticker}&ops=clear"
+
+    @staticmethod
+    def latest_trading_day(now: Optional[datetime] = None) -> datetime:
+        """Latest weekday on or before now, matching how gain runs roll weekend dates back"""
+        day = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        while day.weekday() >= 5:
+            day -= timedelta(days=1)
+        return day
+
+    def fetch_page(self, ticker: str) -> Tuple[Optional[str], bool]:
+        """Today's page for the ticker as (body, from_cache); body is None on failure"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        if self.response_cache is not None:
+            body = self.response_cache.get_response(self.name, ticker, today)
+            if body is not None:
+                return body, True
+
+        response = self.fetcher.get(self.name, self.url(ticker))
+        if response.status_code != 200:
+            return None, False
+        if self.response_cache is not None:
+            self.response_cache.store_response(self.name, ticker, today, response.text)
+        return response.text, False
+
+    def fetch_gains(self, ticker: str, dates: List[datetime]) -> Optional[List[float]]:
+        # Today's trailing returns would be stored as the gains of an older date
+        if not dates or dates[0].date() < self.latest_trading_day().date():
+            return None
+
+        try:
+            body, _ = self.fetch_page(ticker)
+            if body is None:
+                return None
+
+            returns = parse_trailing_returns(body)
+            gains = [0.0] * len(dates)
+            for period, index in self.PERIOD_COLUMNS.items():
+                if index < len(gains) and returns.get(period) is not None:
+                    gains[index] = round(returns[period], 2)
+
+            # A page without any of the mapped returns falls back to the next provider
+            if not any(gains):
+                return None
+            return gains
+
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"Error fetching from Morningstar: {e}")
+            return None
+
+
+class FixtureProvider(PriceProvider):
+    """
+    Recorded daily history for offline runs and load tests
+
+    source is either a directory holding <TICKER>.csv files or the base URL of a
+    fixture server (see fixture_server.py) serving the same files.
+    """
+
+    name = 'fixture'
+
+    def __init__(self, source: str, fetcher: Optional[PriceFetcher] = None):
+        super().__init__(fetcher)
+        self.source = source
+
+    def fetch_prices(self, ticker: str, start_date: datetime, end_date: datetime) -> Optional[Dict[str, float]]:
+        try:
+            if self.source.startswith(('http://', 'https://')):
+                response = self.fetcher.get(self.name, f"{self.source.rstrip('/')}/{ticker}.csv")
+                if response.status_code != 200:
+                    return None
+                text = response.text
+            else:
+                path = os.path.join(self.source, f"{ticker}.csv")
+                if not os.path.exists(path):
+                    return None
+                with open(path, newline='') as f:
+                    text = f.read()
+
+            # end_date is exclusive, as with Yahoo's period2
+            prices = parse_history_csv(text, start_date)
+            last = end_date.strftime('%Y-%m-%d')
+            return {day: close for day, close in prices.items() if day < last}
+
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"Error reading fixture prices for {ticker}: {e}")
+            return None
+
+
+class ProviderChain:
+    """
+    Tries providers in priority order and remembers which one succeeded per ticker
+
+    The remembered provider is tried first on later runs. With state_path set the
+    choices are kept in a small JSON file between runs.
+    """
+
+    def __init__(self, providers: List[PriceProvider], state_path: Optional[str] = None):
+        self.providers = providers
+        self.state_path = state_path
+        self.preferred = {}  # ticker -> provider name
+        self._lock = threading.Lock()
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                self.preferred = json.load(f)
+
+    def provider(self, name: str) -> Optional[PriceProvider]:
+        """Provider with the given name, if it is part of the chain"""
+        return next((provider for provider in self.providers if provider.name == name), None)
+
+    def order_for(self, ticker: str) -> List[PriceProvider]:
+        """Providers to try for the ticker, the one that last succeeded first"""
+        with self._lock:
+            preferred = self.preferred.get(ticker)
+        return sorted(self.providers, key=lambda provider: provider.name != preferred)
+
+    def fetch(self, ticker: str, attempt: Callable[[PriceProvider], Optional[object]]) -> Optional[object]:
+        """
+        Call attempt(provider) down the chain until one returns a result
+
+        Args:
+            ticker: Ticker being fetched
+            attempt: Fetches the ticker from one provider, returning None on failure
+
+        Returns:
+            The first non-None result, or None if every provider failed
+        """
+        for provider in self.order_for(ticker):
+            result = attempt(provider)
+            if result is not None:
+                with self._lock:
+                    self.preferred[ticker] = provider.name
+                return result
+        return None
+
+    def save(self):
+        """Persist the remembered provider per ticker"""
+        if not self.state_path:
+            return
+        with self._lock:
+            with open(self.state_path, 'w') as f:
+                json.dump(self.preferred, f, indent=2, sort_keys=True)
@@ -5,14 +5,33 @@ Reads Asset.xls and processes investment data
 
 import pandas as pd
 from datetime import datetime
-from asset_processor import AssetDatabase, AssetAllocator, GainCalculator, TemplateManager
+from asset_processor import AssetDatabase, AssetAllocator, AssetIndex, GainCalculator, TemplateCache, TemplateManager
+from attribution import AttributionEngine
+from broker_parsers import PARSERS, PositionAggregator, file_digest, parse_exports, parsers_fingerprint
+from gains_matrix import HORIZONS
+from price_cache import PriceCache
+from price_providers import FixtureProvider, MorningstarProvider, PriceFetcher, ProviderChain, YahooProvider
+from returns_engine import ReturnsEngine
 from utils import filter_ticker, get_held_at, empty_to_default, clean_up
 import sys
 import os
-import csv
 from dotenv import load_dotenv
 import msoffcrypto
 import io
+import re
+import time
+import contextlib
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# Dated source copies written by the processall.sh backup action, e.g. backup/Fidelity_2026-06-19.csv;
+# each broker export is named after its file name stem
+BACKUP_SOURCE_KEYS = {os.path.splitext(parser.filename)[0]: name for name, parser in PARSERS.items()}
+BACKUP_SOURCE_KEYS['allaccounts'] = 'allaccounts'
+BACKUP_FILE_PATTERN = re.compile(
+    r'^(' + '|'.join(map(re.escape, BACKUP_SOURCE_KEYS)) + r')_(\d{4}-\d{2}-\d{2})\.csv$'
+)
 
 
 class AssetProcessor:
@@ -43,232 +62,35 @@ class AssetProcessor:
             password='sa123',
             database='asset'
         )
-        self.allocator = AssetAllocator(self.db)
-        self.gain_calculator = GainCalculator(self.db)
-        self.template_manager = TemplateManager(self.db)
-
-    @staticmethod
-    def _parse_currency_value(value):
-        """Convert currency-like strings to float, returning None when invalid."""
-        if value is None:
-            return None
-        if isinstance(value, (int, float)):
-            return float(value)
-
-        text = str(value).strip()
-        if text == '' or text == '-':
-            return None
-
-        # Handle accounting format like (1,234.56)
-        is_negative = text.startswith('(') and text.endswith(')')
-        cleaned = text.replace('$', '').replace(',', '').replace('%', '').strip('()').strip()
-
-        try:
-            amount = float(cleaned)
-            return -amount if is_negative else amount
-        except ValueError:
-            return None
-
-    def read_trow_csv_entries(self, csv_path: str) -> list:
-        """
-        Read T. Rowe Price holdings from CSV and return normalized account_ticker entries.
-
-        CSV format contains two sections:
-        1) Account holdings table with account type/ticker/market value.
-        2) Retirement plan table after a 'TRPRps' marker line where rows are name$amt.
-        """
-        if not os.path.exists(csv_path):
-            raise FileNotFoundError(f"Trow CSV file not found: {csv_path}")
-
-        account_mapping = {
-            'Rollover IRA': 'TRPRollover',
-            'Individual': 'TRPInv',
-            'Roth IRA': 'TRPRoth',
-        }
-
-        entries = []
-        trprps_by_ticker = {}
-        in_rps_section = False
-        rps_pending_name = None
-
-        trprps_mapping = {
-            'VANGUARD INST EXT MKT IDX D': 'VIIIX',
-            'VANGUARD INST 500 IDX TR D': 'VIEIX',
-            'TRP STABLE VALUE COMM TR FD-N': 'Cash',
-            'VANGUARD FTSE SOCIAL INDEX I': 'VFTNX',
-            'TRP US SMALL-CAP VALUE EQ TR-D': 'PRSVX',
-            'VANGUARD TTL INTL MKT IDX D': 'TRCEX',
-        }
-
-        with open(csv_path, 'r', newline='', encoding='utf-8-sig') as f:
-            reader = csv.reader(f)
-
-            for raw_row in reader:
-                row = [cell.strip() if cell is not None else '' for cell in raw_row]
-                if not row or all(cell == '' for cell in row):
-                    continue
-
-                # Detect second section marker: TRPRps
-                if len(row) >= 1 and row[0].strip().lower() == 'trprps':
-                    in_rps_section = True
-                    continue
-
-                # Backward compatibility with older second-table header.
-                if len(row) >= 2 and row[0].lower() == 'investment name' and row[1].lower() == 'amount':
-                    in_rps_section = True
-                    continue
-
-                if in_rps_section:
-                    if len(row) < 1:
-                        continue
-
-                    # Amounts include commas and are unquoted in trow.csv, so csv.reader
-                    # may split a single logical row into multiple columns.
-                    line = ','.join(row).strip()
-
-                    # Format 1: alternating lines — fund name on one line, amount on next.
-                    # Format 2: single line in the form: Investment Name$123,456.78
-                    if '$' not in line:
-                        # This is a fund name line; hold it for the next amount line.
-                        rps_pending_name = line
-                        continue
-
-                    # Line contains '$' — could be a standalone amount line or name$amount.
-                    if line.startswith('$') and rps_pending_name is not None:
-                        # Alternating format: amount line following a name line.
-                        inv_name = rps_pending_name
-                        amount = self._parse_currency_value(line)
-                        rps_pending_name = None
-                    else:
-                        # Single-line format: Investment Name$123,456.78
-                        rps_pending_name = None
-                        inv_name, amt_part = line.rsplit('$', 1)
-                        inv_name = inv_name.strip()
-                        amount = self._parse_currency_value(f'${amt_part.strip()}')
-
-                    if amount is None or amount == 0:
-                        continue
-
-                    mapped_ticker = trprps_mapping.get(inv_name)
-                    if mapped_ticker:
-                        trprps_by_ticker[mapped_ticker] = trprps_by_ticker.get(mapped_ticker, 0.0) + amount
-                    elif inv_name.upper().startswith('TRP RETIREMENT BLEND'):
-                        trprps_by_ticker['TRRIX'] = trprps_by_ticker.get('TRRIX', 0.0) + amount
-                    continue
-
-                # Skip the first section header row.
-                if len(row) >= 1 and row[0].lower() == 'category':
-                    continue
-
-                if len(row) < 10:
-                    continue
-
-                account_type = row[1]
-                ticker = row[3]
-                market_value = self._parse_currency_value(row[9])
-
-                account_prefix = account_mapping.get(account_type)
-                if not account_prefix:
-                    continue
-
-                # Match existing Trow behavior: skip blank ticker and zero/empty value.
-                if ticker == '' or market_value is None or market_value == 0:
-                    continue
-
-                entries.append({
-                    'account_ticker': f"{account_prefix}_{ticker}",
-                    'amount': market_value
-                })
-
-        for ticker, total_amount in trprps_by_ticker.items():
-            if total_amount == 0:
-                continue
-            entries.append({
-                'account_ticker': f'TRPRps_{ticker}',
-                'amount': total_amount
-            })
-
-        return entries
+        # Shared so template edits invalidate what the allocator has cached
+        self.template_cache = TemplateCache(self.db)
+        self.allocator = AssetAllocator(self.db, self.template_cache)
+        # Daily closes are cached next to the Excel file so gain runs only fetch new days
+        base_dir = os.path.dirname(os.path.abspath(self.excel_file))
+        self.price_cache = PriceCache(os.path.join(base_dir, 'price_cache.db'))
+        fetcher = PriceFetcher()
+        self.gain_calculator = GainCalculator(self.db, fetcher=fetcher, price_cache=self.price_cache,
+                                              providers=self.price_providers(fetcher=fetcher))
+        self.template_manager = TemplateManager(self.db, self.template_cache)
     
-    def read_stocks_csv_entries(self, csv_path: str) -> list:
-        """
-        Read stock holdings from CSV and calculate Stock = Total - Cash.
-        
-        CSV format has three columns (no header, tab-delimited):
-        1. Account name
-        2. Category (Stock, Cash, Total)
-        3. Value
-        
-        Returns a list of entries with account_ticker and amount
+    def price_providers(self, price_source: str = None, fetcher: PriceFetcher = None) -> ProviderChain:
         """
-        if not os.path.exists(csv_path):
-            raise FileNotFoundError(f"Stocks CSV file not found: {csv_path}")
-        
-        accounts = {}  # Dict to store {account_name: {Stock, Cash, Total}}
-        entries = []
+        Provider chain for gains, remembering per ticker which provider succeeded
         
-        with open(csv_path, 'r', newline='', encoding='utf-8-sig') as f:
-            reader = csv.reader(f, delimiter='\t')
-            
-            for raw_row in reader:
-                row = [cell.strip() if cell is not None else '' for cell in raw_row]
-                
-                # Skip empty rows
-                if not row or all(cell == '' for cell in row):
-                    continue
-                
-                # Skip rows with insufficient columns
-                if len(row) < 3:
-                    continue
-                
-                account_name = row[0].strip()
-                category = row[1].strip()
-                
-                # Skip if account or category is empty
-                if not account_name or not category:
-                    continue
-                
-                try:
-                    value = float(row[2])
-                except (ValueError, IndexError):
-                    continue
-                
-                # Initialize account dict if needed
-                if account_name not in accounts:
-                    accounts[account_name] = {'Stock': None, 'Cash': None, 'Total': None}
-                
-                # Store the value by category
-                if category in accounts[account_name]:
-                    accounts[account_name][category] = value
-        
-        # Calculate Stock = Total - Cash for each account and create entries
-        for account_name, values in accounts.items():
-            total = values.get('Total')
-            cash = values.get('Cash')
-            
-            # Skip if we don't have Total and Cash values
-            if total is None or cash is None:
-                continue
-            
-            # Add Cash entry if non-zero
-            if cash != 0:
-                entries.append({
-                    'account_ticker': f'{account_name}_Cash',
-                    'amount': cash
-                })
-            
-            # Calculate and add stock value
-            stock_value = total - cash
+        Args:
+            price_source: Optional fixture directory or fixture server URL; when given,
+                prices come only from it (offline runs and load tests)
+            fetcher: Shared fetcher, so rate limits, breakers and metrics cover every provider
             
-            # Add Stock entry if non-zero
-            if stock_value != 0:
-                entries.append({
-                    'account_ticker': f'{account_name}_Stock',
-                    'amount': stock_value
-                })
-        
-        return entries
-    
+        Returns:
+            ProviderChain for GainCalculator
+        """
+        fetcher = fetcher or PriceFetcher()
+        if price_source:
+            return ProviderChain([FixtureProvider(price_source, fetcher)])
+        state_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'provider_state.json')
+        return ProviderChain([MorningstarProvider(fetcher, self.price_cache), YahooProvider(fetcher)], state_path)
+
     def convert_xls_to_xlsx(self, xls_file: str, xlsx_file: str):
         """
         Convert .xls file to .xlsx format
@@ -350,177 +172,274 @@ class AssetProcessor:
             import traceback
             traceback.print_exc()
     
-    def normalize_full_view(self, sheet_name: str = 'fidfullview', output_file: str = None) -> pd.DataFrame:
+    def normalize_positions(self, source_files: dict = None) -> PositionAggregator:
+        """
+        Parse and aggregate every registered broker export
+        
+        Args:
+            source_files: Optional paths by parser name ('fidelity', 'trow', 'stocks')
+                replacing the live files (e.g. dated copies in backup/); when given, every
+                registered export must be listed so no live file is mixed in
+            
+        Returns:
+            Merged PositionAggregator; raises if a required export cannot be read
+        """
+        base_dir = os.path.dirname(os.path.abspath(self.excel_file))
+        if source_files is None:
+            paths = {name: os.path.join(base_dir, parser.filename) for name, parser in PARSERS.items()}
+        else:
+            missing = [parser.filename for name, parser in PARSERS.items() if name not in source_files]
+            if missing:
+                raise Exception(f"No path given for {', '.join(missing)}")
+            paths = {name: source_files[name] for name in PARSERS}
+        
+        # Parse every registered export concurrently, then merge the per-export totals in
+        # registry order so the result does not depend on which export finished first
+        print(f"Reading {', '.join(os.path.basename(path) for path in paths.values())}...")
+        started = time.perf_counter()
+        parsed = parse_exports(paths)
+        
+        required_error = None
+        for name, (_, count, seconds, error) in parsed.items():
+            file_name = os.path.basename(paths[name])
+            if error is None:
+                print(f"  {file_name}: {count} entries in {seconds:.2f}s")
+            elif PARSERS[name].required:
+                required_error = required_error or error
+                print(f"  Error: Could not read {file_name}: {error}")
+            else:
+                print(f"  Warning: Could not read {file_name}: {error}")
+        print(f"Read {len(paths)} exports in {time.perf_counter() - started:.2f}s")
+        if required_error is not None:
+            raise required_error
+        
+        totals = PositionAggregator.combine(part for part, _, _, error in parsed.values() if error is None)
+        summary_df = totals.summary()
+        
+        entries = sum(1 for amount in totals.amounts.values() if amount != 0)
+        print(f"\nNormalized {entries} fund entries across {len(summary_df)} accounts")
+        print("\nAccount Totals:")
+        for _, row in summary_df.iterrows():
+            print(f"  {row['account']}: ${row['total']:,.2f}")
+        return totals
+    
+    def write_normalized(self, results_df: pd.DataFrame, summary_df: pd.DataFrame, output_file: str = None,
+                         write_csv: bool = True) -> bool:
+        """
+        Write normalized results to allaccounts.csv and optionally an Excel file
+        
+        Args:
+            results_df: account_ticker/amount rows
+            summary_df: account/total rows
+            output_file: Optional output Excel file to save results
+            write_csv: Write the results to allaccounts.csv
+            
+        Returns:
+            False if allaccounts.csv could not be written (it still holds an older run)
         """
-        Normalize and aggregate Fidelity data by account
-        Reads data from Fidelity.csv instead of Excel sheet
+        # Write results to allaccounts.csv
+        written = True
+        if write_csv:
+            try:
+                csv_output_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'allaccounts.csv')
+                results_df.to_csv(csv_output_path, index=False)
+                print(f"\nResults written to {csv_output_path}")
+            except Exception as e:
+                print(f"Warning: Could not write to allaccounts.csv: {e}")
+                written = False
+        
+        # Save to separate output file if specified
+        if output_file:
+            with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+                results_df.to_excel(writer, sheet_name='Details', index=False)
+                summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            print(f"\nResults also saved to {output_file}")
+        return written
+    
+    def normalize_full_view(self, sheet_name: str = 'fidfullview', output_file: str = None,
+                            source_files: dict = None, write_csv: bool = True) -> pd.DataFrame:
+        """
+        Normalize and aggregate broker exports by account
+        Reads every export registered in broker_parsers (Fidelity.csv, trow.csv, stocks.csv)
+        instead of the Excel sheet
         Converted from VBA normalizefullview() function
         
         Args:
             sheet_name: Deprecated - kept for backward compatibility
             output_file: Optional output Excel file to save results
+            source_files: Optional paths by parser name ('fidelity', 'trow', 'stocks')
+                replacing the live files, see normalize_positions
+            write_csv: Write the results to allaccounts.csv
             
         Returns:
             DataFrame with normalized data
         """
-        print(f"Reading Fidelity data from Fidelity.csv...")
-        
-        # Read Fidelity.csv - it has header row with columns: Account Name, Symbol, Current Value, etc.
-        csv_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'Fidelity.csv')
-        if not os.path.exists(csv_path):
-            raise FileNotFoundError(f"Fidelity.csv not found at {csv_path}")
-        
-        # Read CSV - due to trailing commas in data, columns are shifted by 1
-        # We'll use positional indexing to get the correct columns
-        df_raw = pd.read_csv(csv_path)
-        
-        # Account mapping based on Account Name values
-        account_mapping = {
-            'Individual - TOD': 'FidelityInv',
-            'Rollover IRA': 'FidelityIRA',
-            'Samir S Doshi - Brokerage Account - 10498558': 'Vanguard',
-            'Samir S Doshi - Rollover IRA': 'Vanguard IRA'
-        }
+        totals = self.normalize_positions(source_files)
+        results_df = totals.positions()
+        summary_df = totals.summary()
+        self.write_normalized(results_df, summary_df, output_file, write_csv)
+        return results_df, summary_df
+    
+    def normalize_fingerprint(self, prevdate: str = None, currdate: str = None) -> dict:
+        """
+        Fingerprint of everything a normalize run depends on
         
-        account_data = {}  # Dictionary to store aggregated amounts by account
-        ticker_data = {}  # Dictionary to aggregate by account_ticker combination
-        
-        # Process each row using positional indexing
-        for idx, row in df_raw.iterrows():
-            # Due to trailing commas, columns are shifted:
-            # Column 0 (Account Number) contains Account Name
-            # Column 1 (Account Name) contains Symbol
-            # Column 2 (Symbol) contains Description
-            # Column 6 (Last Price Change) contains Current Value
-            account_name = row.iloc[0]  # From Account Number column
-            symbol = row.iloc[1]  # From Account Name column
-            description = row.iloc[2]  # From Symbol column
-            value = row.iloc[6]  # From Last Price Change column
-            
-            # Skip if any required field is missing or empty
-            if pd.isna(account_name) or pd.isna(symbol) or pd.isna(value):
-                continue
-            
-            account_name = str(account_name).strip()
-            symbol = str(symbol).strip()
-            
-            if account_name == '' or symbol == '':
-                continue
-            
-            # Handle stock entries where Symbol='Stock'
-            if symbol == 'Stock':
-                # Keep symbol as 'Stock' so all individual stocks are aggregated
-                symbol = 'Stock'
-            else:
-                # Strip trailing ** (e.g. FCASH** -> FCASH, FDRXX** -> FDRXX)
-                symbol = symbol.rstrip('*')
-                
-                # Map specific symbols to Cash
-                if symbol in ['FDRXX', 'FCASH', 'Pending activity', 'VMRXX', 'VMFXX']:
-                    symbol = 'Cash'
-            
-            # Clean up value if it's a string
-            if isinstance(value, str):
-                value = value.replace('$', '').replace(',', '')
-                try:
-                    value = float(value)
-                except:
-                    continue
-            
-            # Skip zero values
-            if value == 0:
-                continue
-            
-            # Map account name to prefix
-            account_prefix = account_mapping.get(account_name, None)
-            
-            # Skip if account not in mapping (handled separately by trow.csv)
-            if not account_prefix:
-                continue
-            
-            # Create account_ticker key
-            account_ticker = f"{account_prefix}_{symbol}"
-            
-            # Aggregate by account_ticker (sum duplicates)
-            if account_ticker not in ticker_data:
-                ticker_data[account_ticker] = 0
-            ticker_data[account_ticker] += value
+        Args:
+            prevdate: Date written to Assetalloc B1
+            currdate: Date written to Assetalloc C1
             
-            # Aggregate by account
-            if account_prefix not in account_data:
-                account_data[account_prefix] = 0
-            account_data[account_prefix] += value
+        Returns:
+            Dict with the content hash of each broker export, a hash of the parsers and
+            their mappings, and the Assetalloc dates
+        """
+        base_dir = os.path.dirname(os.path.abspath(self.excel_file))
+        return {
+            'exports': {name: file_digest(os.path.join(base_dir, parser.filename)) for name, parser in PARSERS.items()},
+            'parsers': parsers_fingerprint(),
+            'dates': [prevdate, currdate],
+        }
+    
+    def current_normalize_manifest(self, fingerprint: dict) -> dict:
+        """
+        The manifest of the last normalize run if it had the same inputs
         
-        # Convert ticker_data dictionary to list of results
-        results = []
-        for account_ticker, amount in ticker_data.items():
-            results.append({
-                'account_ticker': account_ticker,
-                'amount': amount
-            })
+        Args:
+            fingerprint: Output of normalize_fingerprint for this run
+            
+        Returns:
+            Manifest dict, or None when the inputs changed or allaccounts.csv differs
+            from what that run wrote
+        """
+        base_dir = os.path.dirname(os.path.abspath(self.excel_file))
+        manifest_path = os.path.join(base_dir, 'normalize_manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable {manifest_path}: {e}")
+            return None
         
-        # Create results DataFrame
-        results_df = pd.DataFrame(results)
+        if (manifest.get('inputs') == fingerprint
+                and manifest.get('allaccounts') == file_digest(os.path.join(base_dir, 'allaccounts.csv'))):
+            return manifest
+        return None
+    
+    def save_normalize_manifest(self, fingerprint: dict, summary_df: pd.DataFrame, csv_written: bool = True):
+        """
+        Record the inputs of a normalize run and a hash of the allaccounts.csv it wrote
         
-        # Remove entries with 0 value (shouldn't happen but safety check)
-        if len(results_df) > 0:
-            results_df = results_df[results_df['amount'] != 0]
+        Args:
+            fingerprint: Output of normalize_fingerprint for this run
+            summary_df: account/total rows of this run
+            csv_written: Whether this run wrote allaccounts.csv; if not, the manifest is
+                removed instead so the older file is never reused for these inputs
+        """
+        base_dir = os.path.dirname(os.path.abspath(self.excel_file))
+        manifest_path = os.path.join(base_dir, 'normalize_manifest.json')
+        if not csv_written:
+            try:
+                if os.path.exists(manifest_path):
+                    os.remove(manifest_path)
+            except OSError as e:
+                print(f"Warning: Could not remove {manifest_path}: {e}")
+            return
         
-        # Read Trow holdings from CSV and append using the same account_ticker/amount shape.
         try:
-            trow_csv_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'trow.csv')
-            print(f"Reading Trow data from CSV: {trow_csv_path}")
-            trow_entries = self.read_trow_csv_entries(trow_csv_path)
-
-            if trow_entries:
-                results_df = pd.concat([results_df, pd.DataFrame(trow_entries)], ignore_index=True)
-            print(f"Added {len(trow_entries)} entries from trow.csv")
-        except Exception as e:
-            print(f"Warning: Could not read trow.csv: {e}")
+            with open(manifest_path, 'w') as f:
+                json.dump({
+                    'inputs': fingerprint,
+                    'allaccounts': file_digest(os.path.join(base_dir, 'allaccounts.csv')),
+                    'summary': summary_df.to_dict('records'),
+                    'normalized_at': datetime.now().isoformat(timespec='seconds'),
+                }, f, indent=2)
+        except OSError as e:
+            print(f"Warning: Could not write {manifest_path}: {e}")
+    
+    def run_normalize(self, prevdate: str = None, currdate: str = None, sheet_name: str = 'fidfullview',
+                      output_file: str = None, force: bool = False):
+        """
+        Update the Assetalloc dates and normalize the broker exports, unless nothing changed
         
-        # Read stock account data from CSV and append
-        try:
-            stocks_csv_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'stocks.csv')
-            print(f"Reading Stock account data from CSV: {stocks_csv_path}")
-            stock_entries = self.read_stocks_csv_entries(stocks_csv_path)
-            
-            if stock_entries:
-                results_df = pd.concat([results_df, pd.DataFrame(stock_entries)], ignore_index=True)
-            print(f"Added {len(stock_entries)} entries from stocks.csv")
-        except Exception as e:
-            print(f"Warning: Could not read stocks.csv: {e}")
+        normalize_manifest.json records the inputs of the last run and a hash of the
+        allaccounts.csv it wrote. When the exports, parsers, dates and allaccounts.csv all
+        still match, the workbook is left alone and allaccounts.csv is reused.
         
-        # Sort final results
-        results_df = results_df.sort_values(by='account_ticker', ascending=True)
+        Args:
+            prevdate: Date for Assetalloc B1
+            currdate: Date for Assetalloc C1
+            sheet_name: Deprecated - kept for backward compatibility
+            output_file: Optional output Excel file to save results
+            force: Normalize even when nothing changed
+            
+        Returns:
+            Tuple of (account_ticker/amount DataFrame, account summary DataFrame)
+        """
+        fingerprint = self.normalize_fingerprint(prevdate, currdate)
+        manifest = None if force else self.current_normalize_manifest(fingerprint)
+        if manifest:
+            csv_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'allaccounts.csv')
+            print(f"Inputs unchanged since {manifest.get('normalized_at')}; reusing {csv_path} "
+                  f"(use --force to normalize again)")
+            results_df = pd.read_csv(csv_path)
+            summary_df = pd.DataFrame(manifest.get('summary', []), columns=['account', 'total'])
+            self.write_normalized(results_df, summary_df, output_file, write_csv=False)
+            return results_df, summary_df
+        
+        self.update_assetalloc_dates(prevdate=prevdate, currdate=currdate)
+        totals = self.normalize_positions()
+        results_df = totals.positions()
+        summary_df = totals.summary()
+        written = self.write_normalized(results_df, summary_df, output_file)
+        self.save_normalize_manifest(fingerprint, summary_df, csv_written=written)
+        return results_df, summary_df
+    
+    def normalize_and_process(self, as_of_date: datetime, prevdate: str = None, currdate: str = None,
+                              output_file: str = None, force: bool = False, **process_options):
+        """
+        Normalize the broker exports and allocate the result in one run
         
-        # Create summary DataFrame
-        summary_df = pd.DataFrame([
-            {'account': account, 'total': total}
-            for account, total in account_data.items()
-        ])
+        The normalized positions go straight into process_asset_allocation as a
+        Ticker/Amount/HeldAt frame built from the aggregated keys. allaccounts.csv (and the
+        manifest) is still written as an audit copy, on a background thread while the
+        allocation runs. When the exports are unchanged since the last normalize,
+        allaccounts.csv is reused as in run_normalize.
         
-        print(f"\nNormalized {len(results_df)} fund entries across {len(summary_df)} accounts")
-        print("\nAccount Totals:")
-        for _, row in summary_df.iterrows():
-            print(f"  {row['account']}: ${row['total']:,.2f}")
+        Args:
+            as_of_date: Date for the asset allocation
+            prevdate: Date for Assetalloc B1
+            currdate: Date for Assetalloc C1
+            output_file: Optional output Excel file for the normalized results
+            force: Normalize even when nothing changed
+            **process_options: Passed to run_full_process (delete_existing, bulk, staged, ...)
+        """
+        fingerprint = self.normalize_fingerprint(prevdate, currdate)
+        manifest = None if force else self.current_normalize_manifest(fingerprint)
+        if manifest:
+            print(f"Inputs unchanged since {manifest.get('normalized_at')}; reusing allaccounts.csv "
+                  f"(use --force to normalize again)")
+            self.run_full_process(as_of_date, **process_options)
+            return
         
-        # Write results to allaccounts.csv
-        try:
-            csv_output_path = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'allaccounts.csv')
-            results_df.to_csv(csv_output_path, index=False)
-            print(f"\nResults written to {csv_output_path}")
-        except Exception as e:
-            print(f"Warning: Could not write to allaccounts.csv: {e}")
+        self.update_assetalloc_dates(prevdate=prevdate, currdate=currdate)
+        totals = self.normalize_positions()
+        results_df = totals.positions()
+        summary_df = totals.summary()
         
-        # Save to separate output file if specified
-        if output_file:
-            with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-                results_df.to_excel(writer, sheet_name='Details', index=False)
-                summary_df.to_excel(writer, sheet_name='Summary', index=False)
-            print(f"\nResults also saved to {output_file}")
+        def write_audit_copy():
+            written = self.write_normalized(results_df, summary_df, output_file)
+            self.save_normalize_manifest(fingerprint, summary_df, csv_written=written)
         
-        return results_df, summary_df
-
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            audit_copy = writer.submit(write_audit_copy)
+            try:
+                self.run_full_process(as_of_date, positions=totals.allocation_input(), **process_options)
+            finally:
+                try:
+                    audit_copy.result()
+                except Exception as e:
+                    print(f"Warning: Could not write the normalized results: {e}")
     
     def decrypt_and_read_excel(self, sheet_name: str, header=0) -> pd.DataFrame:
         """
@@ -608,6 +527,45 @@ class AssetProcessor:
                 print("No password found in .env file")
                 raise
     
+    @staticmethod
+    def split_account_tickers(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convert normalized account_ticker/amount rows into allocation input
+        
+        Args:
+            df: DataFrame with account_ticker (e.g. "FidelityInv_FXAIX") and amount columns
+            
+        Returns:
+            DataFrame with columns: Ticker, Amount, HeldAt
+        """
+        # Extract data from account_ticker and amount columns
+        all_data = []
+        
+        for idx, row in df.iterrows():
+            account_ticker = row.get('account_ticker')
+            amount = row.get('amount')
+            
+            if pd.notna(account_ticker) and pd.notna(amount) and amount != 0:
+                # Clean up amount
+                if isinstance(amount, str):
+                    amount = amount.replace('$', '').replace(',', '')
+                    try:
+                        amount = float(amount)
+                    except:
+                        continue
+                
+                # Split account_ticker to get account and ticker
+                account_ticker_str = str(account_ticker)
+                if '_' in account_ticker_str:
+                    held_at, ticker = account_ticker_str.split('_', 1)
+                    all_data.append({
+                        'Ticker': ticker,
+                        'Amount': amount,
+                        'HeldAt': held_at
+                    })
+        
+        return pd.DataFrame(all_data)
+    
     def read_asset_reference_sheet(self, sheet_name: str = 'fullview') -> pd.DataFrame:
         """
         Read asset data from allaccounts.csv
@@ -627,34 +585,7 @@ class AssetProcessor:
             
             # Read CSV file
             df = pd.read_csv(csv_path)
-            
-            # Extract data from account_ticker and amount columns
-            all_data = []
-            
-            for idx, row in df.iterrows():
-                account_ticker = row.get('account_ticker')
-                amount = row.get('amount')
-                
-                if pd.notna(account_ticker) and pd.notna(amount) and amount != 0:
-                    # Clean up amount
-                    if isinstance(amount, str):
-                        amount = amount.replace('$', '').replace(',', '')
-                        try:
-                            amount = float(amount)
-                        except:
-                            continue
-                    
-                    # Split account_ticker to get account and ticker
-                    account_ticker_str = str(account_ticker)
-                    if '_' in account_ticker_str:
-                        held_at, ticker = account_ticker_str.split('_', 1)
-                        all_data.append({
-                            'Ticker': ticker,
-                            'Amount': amount,
-                            'HeldAt': held_at
-                        })
-            
-            result_df = pd.DataFrame(all_data)
+            result_df = self.split_account_tickers(df)
             
             print(f"Successfully read {len(result_df)} entries from allaccounts.csv")
             return result_df
@@ -665,7 +596,22 @@ class AssetProcessor:
             print(f"Error reading allaccounts.csv: {e}")
             sys.exit(1)
     
-    def process_asset_allocation(self, df: pd.DataFrame, as_of_date: datetime, held_at_column: str = 'HeldAt'):
+    @staticmethod
+    def parse_amount(value) -> float:
+        """Amount cell as a float; typed floats pass straight through, blanks are 0"""
+        if isinstance(value, float):
+            return 0 if value != value else value
+        if pd.isna(value):
+            return 0
+        if isinstance(value, str):
+            # Clean up amount (remove $ and ,)
+            value = clean_up(value)
+            return float(value) if value else 0
+        return float(value)
+    
+    def process_asset_allocation(self, df: pd.DataFrame, as_of_date: datetime, held_at_column: str = 'HeldAt',
+                                 bulk: bool = False, batch_size: int = 500, staged: bool = False,
+                                 diff: bool = False) -> list:
         """
         Process asset allocation from DataFrame
         
@@ -673,198 +619,172 @@ class AssetProcessor:
             df: DataFrame with asset data
             as_of_date: Date for the asset allocation
             held_at_column: Column name containing held at information
+            bulk: Collect all rows in memory and write them in one transaction
+            batch_size: Rows per multi-row INSERT in bulk mode
+            staged: Write the bulk rows to the staging tables (implies bulk); publish
+                with allocator.publish_staged()
+            diff: Only insert, update or delete the positions that differ from what
+                is already stored for the date (implies bulk)
+            
+        Returns:
+            List of unresolved tickers as dicts with ticker, held_at and row
         """
-        self.db.open_db()
-        
-        processed_count = 0
-        error_count = 0
-        error_details = []  # Track detailed error information
-        
-        # Assuming columns: Ticker (A), Symbol (B), Amount (E), HeldAt (J)
-        # Adjust column names based on actual Excel structure
-        
-        # Track current stock account being processed
-        current_stock_account = None
-        stock_account_cash = {}  # Track cash amounts for calculating stock value
-        stock_accounts = ['Etrade', 'Ameritrade', 'TradeStation', 'Robinhood']
-        
-        for index, row in df.iterrows():
-            try:
-                # Get ticker
-                ticker = row.get('Ticker', row.get('Symbol', ''))
-                if pd.isna(ticker):
-                    continue
-                
-                ticker = str(ticker).strip()
-                
-                # Check for end marker
-                if ticker == "ENDOFPORTFOLIO":
-                    break
-                
-                # Check if this is a stock account header
-                if ticker in stock_accounts:
-                    current_stock_account = ticker
-                    continue
-                
-                # For stock accounts, process both Cash and Stock rows
-                if current_stock_account:
-                    if ticker == "Cash":
-                        # Process Cash row
-                        amount = row.get('Amount', row.get('Value', 0))
-                        if pd.isna(amount):
-                            amount = 0
-                        else:
-                            # Clean up amount
-                            if isinstance(amount, str):
-                                amount = clean_up(amount)
-                                amount = float(amount) if amount else 0
-                            else:
-                                amount = float(amount)
-                        
-                        # Store cash amount for this account
-                        stock_account_cash[current_stock_account] = amount
-                        
-                        if amount > 0:
-                            # Process as Cash
-                            held_at = current_stock_account
-                            
-                            # Get asset ID for Cash
-                            query = """
-                                SELECT assetid FROM asset 
-                                WHERE ticker = %s OR assetname = %s
-                            """
-                            results = self.db.execute_query(query, ("Cash", "Cash"))
-                            
-                            if not results:
-                                print(f"Warning: Asset not found for ticker Cash")
-                                error_count += 1
-                            else:
-                                asset_id = results[0]['assetid']
-                                print(f"Processing: Cash - ${amount:,.2f} at {held_at}")
-                                self.allocator.allocate_asset_ref(asset_id, as_of_date, amount, held_at)
-                                processed_count += 1
+        with self.db.session():
+            # Resolve tickers in memory instead of querying asset once per row
+            asset_index = AssetIndex().load(self.db)
+            
+            bulk = bulk or staged or diff
+            if bulk:
+                self.allocator.begin_bulk(as_of_date, batch_size, staged=staged, diff=diff)
+            
+            processed_count = 0
+            error_count = 0
+            error_details = []  # Track detailed error information
+            
+            # Assuming columns: Ticker (A), Symbol (B), Amount (E), HeldAt (J)
+            # Adjust column names based on actual Excel structure
+            
+            # Track current stock account being processed
+            current_stock_account = None
+            stock_account_cash = {}  # Track cash amounts for calculating stock value
+            stock_accounts = ['Etrade', 'Ameritrade', 'TradeStation', 'Robinhood']
+            
+            # Read each column once instead of building a Series per row
+            def column(*names, default=''):
+                for name in names:
+                    if name in df.columns:
+                        return df[name].tolist()
+                return [default] * len(df)
+            
+            rows = zip(df.index.tolist(), column('Ticker', 'Symbol'), column('Amount', 'Value', default=0),
+                       column(held_at_column, 'HeldAt'))
+            for index, ticker, row_amount, row_held_at in rows:
+                try:
+                    # Skip blank tickers
+                    if pd.isna(ticker):
                         continue
-                        
-                    elif ticker == "Stock":
-                        # Skip Stock row (it's a formula, we'll calculate from Total - Cash)
+                    
+                    ticker = str(ticker).strip()
+                    
+                    # Check for end marker
+                    if ticker == "ENDOFPORTFOLIO":
+                        break
+                    
+                    # Check if this is a stock account header
+                    if ticker in stock_accounts:
+                        current_stock_account = ticker
                         continue
-                        
-                    elif ticker == "Total":
-                        # Process Total row - calculate Stock value
-                        total_amount = row.get('Amount', row.get('Value', 0))
-                        if pd.isna(total_amount):
-                            total_amount = 0
-                        else:
-                            # Clean up amount
-                            if isinstance(total_amount, str):
-                                total_amount = clean_up(total_amount)
-                                total_amount = float(total_amount) if total_amount else 0
-                            else:
-                                total_amount = float(total_amount)
-                        
-                        # Calculate Stock = Total - Cash
-                        cash_amount = stock_account_cash.get(current_stock_account, 0)
-                        stock_amount = total_amount - cash_amount
-                        
-                        if stock_amount > 0:
-                            # Process as Stock
-                            held_at = current_stock_account
+                    
+                    # For stock accounts, process both Cash and Stock rows
+                    if current_stock_account:
+                        if ticker == "Cash":
+                            # Process Cash row
+                            amount = self.parse_amount(row_amount)
                             
-                            # Get asset ID for Stock
-                            query = """
-                                SELECT assetid FROM asset 
-                                WHERE ticker = %s OR assetname = %s
-                            """
-                            results = self.db.execute_query(query, ("Stock", "Stock"))
+                            # Store cash amount for this account
+                            stock_account_cash[current_stock_account] = amount
                             
-                            if not results:
-                                print(f"Warning: Asset not found for ticker Stock")
-                                error_count += 1
-                                error_details.append(f"Asset not found: Stock (for {held_at})")
-                            else:
-                                asset_id = results[0]['assetid']
-                                print(f"Processing: Stock - ${stock_amount:,.2f} at {held_at}")
-                                self.allocator.allocate_asset_ref(asset_id, as_of_date, stock_amount, held_at)
-                                processed_count += 1
-                        
-                        # Reset after Total row
-                        current_stock_account = None
+                            if amount > 0:
+                                # Process as Cash
+                                held_at = current_stock_account
+                                
+                                # Get asset ID for Cash
+                                asset_id = asset_index.resolve("Cash", held_at, index)
+                                
+                                if asset_id is None:
+                                    print(f"Warning: Asset not found for ticker Cash")
+                                    error_count += 1
+                                else:
+                                    print(f"Processing: Cash - ${amount:,.2f} at {held_at}")
+                                    self.allocator.allocate_asset_ref(asset_id, as_of_date, amount, held_at)
+                                    processed_count += 1
+                            continue
+                            
+                        elif ticker == "Stock":
+                            # Skip Stock row (it's a formula, we'll calculate from Total - Cash)
+                            continue
+                            
+                        elif ticker == "Total":
+                            # Process Total row - calculate Stock value
+                            total_amount = self.parse_amount(row_amount)
+                            
+                            # Calculate Stock = Total - Cash
+                            cash_amount = stock_account_cash.get(current_stock_account, 0)
+                            stock_amount = total_amount - cash_amount
+                            
+                            if stock_amount > 0:
+                                # Process as Stock
+                                held_at = current_stock_account
+                                
+                                # Get asset ID for Stock
+                                asset_id = asset_index.resolve("Stock", held_at, index)
+                                
+                                if asset_id is None:
+                                    print(f"Warning: Asset not found for ticker Stock")
+                                    error_count += 1
+                                    error_details.append(f"Asset not found: Stock (for {held_at})")
+                                else:
+                                    print(f"Processing: Stock - ${stock_amount:,.2f} at {held_at}")
+                                    self.allocator.allocate_asset_ref(asset_id, as_of_date, stock_amount, held_at)
+                                    processed_count += 1
+                            
+                            # Reset after Total row
+                            current_stock_account = None
+                            continue
+                        else:
+                            # Skip other rows
+                            continue
+                    
+                    # Skip total/summary rows for regular accounts
+                    if 'Total' in ticker or 'total' in ticker:
                         continue
-                    else:
-                        # Skip other rows
+                    
+                    # Filter invalid tickers
+                    ticker = filter_ticker(ticker)
+                    if not ticker:
                         continue
-                
-                # Skip total/summary rows for regular accounts
-                if 'Total' in ticker or 'total' in ticker:
-                    continue
-                
-                # Filter invalid tickers
-                ticker = filter_ticker(ticker)
-                if not ticker:
-                    continue
-                
-                # Apply fund mapping (e.g., VMRXX -> VMMXX)
-                fund_mapping = {
-                    'VMRXX': 'VMMXX'
-                }
-                if ticker in fund_mapping:
-                    original_ticker = ticker
-                    ticker = fund_mapping[ticker]
-                    print(f"Mapped {original_ticker} -> {ticker}")
-                
-                # Get held at location
-                held_at = row.get(held_at_column, row.get('HeldAt', ''))
-                if pd.isna(held_at):
-                    held_at = ''
-                else:
-                    held_at = str(held_at).strip()
-                
-                if not held_at:
-                    print(f"Warning: No 'HeldAt' location for ticker {ticker}")
-                    continue
-                
-                # Get amount
-                amount = row.get('Amount', row.get('Value', 0))
-                if pd.isna(amount):
-                    amount = 0
-                else:
-                    # Clean up amount (remove $ and ,)
-                    if isinstance(amount, str):
-                        amount = clean_up(amount)
-                        amount = float(amount) if amount else 0
-                    else:
-                        amount = float(amount)
-                
-                if amount == 0:
-                    continue
-                
-                # Get asset ID from database
-                query = """
-                    SELECT assetid FROM asset 
-                    WHERE ticker = %s OR assetname = %s
-                """
-                results = self.db.execute_query(query, (ticker, ticker))
-                
-                if not results:
-                    print(f"Warning: Asset not found for ticker {ticker}")
+                    
+                    # Apply fund mapping (e.g., VMRXX -> VMMXX)
+                    mapped_ticker = asset_index.canonical_ticker(ticker)
+                    if mapped_ticker != ticker:
+                        print(f"Mapped {ticker} -> {mapped_ticker}")
+                        ticker = mapped_ticker
+                    
+                    # Get held at location
+                    held_at = '' if pd.isna(row_held_at) else str(row_held_at).strip()
+                    
+                    if not held_at:
+                        print(f"Warning: No 'HeldAt' location for ticker {ticker}")
+                        continue
+                    
+                    # Get amount
+                    amount = self.parse_amount(row_amount)
+                    
+                    if amount == 0:
+                        continue
+                    
+                    # Get asset ID from the preloaded index
+                    asset_id = asset_index.resolve(ticker, held_at, index)
+                    
+                    if asset_id is None:
+                        print(f"Warning: Asset not found for ticker {ticker}")
+                        error_count += 1
+                        error_details.append(f"Asset not found: {ticker}")
+                        continue
+                    
+                    # Allocate the asset
+                    print(f"Processing: {ticker} - ${amount:,.2f} at {held_at}")
+                    self.allocator.allocate_asset_ref(asset_id, as_of_date, amount, held_at)
+                    processed_count += 1
+                    
+                except Exception as e:
+                    print(f"Error processing row {index}: {e}")
                     error_count += 1
-                    error_details.append(f"Asset not found: {ticker}")
+                    error_details.append(f"Row {index}: {e}")
                     continue
-                
-                asset_id = results[0]['assetid']
-                
-                # Allocate the asset
-                print(f"Processing: {ticker} - ${amount:,.2f} at {held_at}")
-                self.allocator.allocate_asset_ref(asset_id, as_of_date, amount, held_at)
-                processed_count += 1
-                
-            except Exception as e:
-                print(f"Error processing row {index}: {e}")
-                error_count += 1
-                error_details.append(f"Row {index}: {e}")
-                continue
-        
-        self.db.close_db()
+            
+            if bulk:
+                self.allocator.flush_bulk()
         
         print(f"\n=== Processing Complete ===")
         print(f"Processed: {processed_count} assets")
@@ -874,6 +794,8 @@ class AssetProcessor:
             print(f"\nError details:")
             for error in error_details:
                 print(f"  - {error}")
+        
+        return asset_index.unresolved
     
     def compare_dates_report(self, currdate: datetime, datetocompare: datetime, threshold_percent: float = 5.0, show_all: bool = False):
         """
@@ -1112,6 +1034,24 @@ class AssetProcessor:
         self.allocator.delete_asset_info(as_of_date)
         print("Deletion complete")
     
+    def delete_existing_gains(self, as_of_date: datetime):
+        """
+        Delete gains for a given date (and gains older than 24 months)
+        
+        Args:
+            as_of_date: Date to delete gains for
+        """
+        print(f"Deleting existing gains for {as_of_date.strftime('%Y-%m-%d')}...")
+        with self.db.session():
+            try:
+                self.db.begin_transaction()
+                self.allocator.delete_gains(self.allocator.mysql_date(as_of_date))
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        print("Deletion complete")
+    
     def calculate_gains(self, as_of_date: datetime):
         """
         Calculate gains for all assets
@@ -1385,7 +1325,9 @@ class AssetProcessor:
         print("=" * 60)
     
     def run_full_process(self, as_of_date: datetime, sheet_name: str = 'fullview', 
-                        delete_existing: bool = True, calculate_gains: bool = False):
+                        delete_existing: bool = True, calculate_gains: bool = False,
+                        bulk: bool = False, batch_size: int = 500, staged: bool = False,
+                        diff: bool = False, positions: pd.DataFrame = None):
         """
         Run the full asset processing workflow
         
@@ -1394,7 +1336,17 @@ class AssetProcessor:
             sheet_name: Name of the sheet to read
             delete_existing: Whether to delete existing data first
             calculate_gains: Whether to calculate gains after allocation (default: False)
+            bulk: Use the batched bulk-write allocation path
+            batch_size: Rows per multi-row INSERT in bulk mode
+            staged: Load the date into staging tables with the bulk path, validate
+                totals there and publish atomically (replaces the separate delete step)
+            diff: Re-allocate incrementally, touching only positions that changed
+                since the last run (holdings are not deleted first)
+            positions: Ticker/Amount/HeldAt rows to allocate instead of reading allaccounts.csv
         """
+        if staged and diff:
+            raise Exception("--staged and --diff cannot be combined")
+        
         print("=" * 60)
         print("Asset Processing Workflow")
         print("=" * 60)
@@ -1403,18 +1355,29 @@ class AssetProcessor:
         print(f"As of Date: {as_of_date.strftime('%Y-%m-%d')}")
         print("=" * 60)
         
-        # Step 1: Delete existing data if requested
-        if delete_existing:
+        # Step 1: Delete existing data if requested (staged runs replace the date when publishing,
+        # diff runs keep the stored holdings and only drop the date's gains)
+        if delete_existing and diff:
+            self.delete_existing_gains(as_of_date)
+        elif delete_existing and not staged:
             self.delete_existing_data(as_of_date)
         
-        # Step 2: Read Excel data
-        print("\nReading Excel file...")
-        df = self.read_asset_reference_sheet(sheet_name)
-        print(f"Read {len(df)} rows from Excel")
+        # Step 2: Read Excel data (unless normalized positions were handed over in memory)
+        if positions is None:
+            print("\nReading Excel file...")
+            df = self.read_asset_reference_sheet(sheet_name)
+            print(f"Read {len(df)} rows from Excel")
+        else:
+            df = positions
+            print(f"\nUsing {len(df)} normalized positions")
         
         # Step 3: Process asset allocation
         print("\nProcessing asset allocation...")
-        self.process_asset_allocation(df, as_of_date)
+        self.process_asset_allocation(df, as_of_date, bulk=bulk, batch_size=batch_size, staged=staged, diff=diff)
+        
+        if staged:
+            print("\nPublishing staged allocation...")
+            self.allocator.publish_staged(delete_gains=delete_existing)
         
         # Step 4: Calculate gains if requested
         if calculate_gains:
@@ -1424,6 +1387,160 @@ class AssetProcessor:
         print("Processing Complete!")
         print("=" * 60)
 
+    def find_backup_snapshots(self, from_date: datetime, to_date: datetime, backup_dir: str = None) -> dict:
+        """
+        Discover dated CSV snapshots in the backup directory
+        
+        Args:
+            from_date: First date to include
+            to_date: Last date to include
+            backup_dir: Directory to scan (default: backup/ next to the Excel file)
+            
+        Returns:
+            Dictionary of 'YYYY-MM-DD' -> {'fidelity'|'trow'|'stocks'|'allaccounts': path}, sorted by date
+        """
+        if backup_dir is None:
+            backup_dir = os.path.join(os.path.dirname(os.path.abspath(self.excel_file)), 'backup')
+        if not os.path.isdir(backup_dir):
+            raise FileNotFoundError(f"Backup directory not found at {backup_dir}")
+        
+        first, last = from_date.strftime('%Y-%m-%d'), to_date.strftime('%Y-%m-%d')
+        snapshots = {}
+        for name in os.listdir(backup_dir):
+            match = BACKUP_FILE_PATTERN.match(name)
+            if match and first <= match.group(2) <= last:
+                source, date_str = match.groups()
+                snapshots.setdefault(date_str, {})[BACKUP_SOURCE_KEYS[source]] = os.path.join(backup_dir, name)
+        
+        return dict(sorted(snapshots.items()))
+    
+    def backfill(self, from_date: datetime, to_date: datetime, workers: int = None, batch_size: int = 500,
+                 backup_dir: str = None) -> dict:
+        """
+        Reprocess historical snapshots from backup/ CSVs
+        
+        Snapshots are normalized in a process pool; each date is then allocated in date
+        order with the staged bulk path, replacing that date's holdings atomically.
+        Dates missing any broker export fall back to their allaccounts CSV; dates with
+        neither fail, naming the missing exports. Live exports are never read.
+        
+        Args:
+            from_date: First date to reprocess
+            to_date: Last date to reprocess
+            workers: Normalization processes (default: CPU count)
+            batch_size: Rows per multi-row INSERT
+            backup_dir: Directory with the dated CSVs (default: backup/ next to the Excel file)
+            
+        Returns:
+            Dictionary of 'YYYY-MM-DD' -> number of positions allocated (failed dates are omitted)
+        """
+        snapshots = self.find_backup_snapshots(from_date, to_date, backup_dir)
+        
+        print("=" * 60)
+        print(f"Backfill {from_date.strftime('%Y-%m-%d')} to {to_date.strftime('%Y-%m-%d')}: {len(snapshots)} snapshot dates")
+        print("=" * 60)
+        if not snapshots:
+            return {}
+        
+        results = {}
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Normalization of later dates overlaps allocation of earlier ones
+            futures = {}
+            for date_str, files in snapshots.items():
+                missing = [f"{os.path.splitext(parser.filename)[0]}_{date_str}.csv"
+                           for name, parser in PARSERS.items() if name not in files]
+                if missing and 'allaccounts' not in files:
+                    futures[date_str] = missing
+                else:
+                    futures[date_str] = executor.submit(_normalize_snapshot, self.excel_file, files)
+            
+            for i, (date_str, future) in enumerate(futures.items(), 1):
+                if isinstance(future, list):
+                    print(f"[{i}/{len(futures)}] {date_str}: FAILED - missing {', '.join(future)} "
+                          f"and allaccounts_{date_str}.csv")
+                    continue
+                
+                # Allocation output is kept so row errors can be reported with the date
+                output = io.StringIO()
+                try:
+                    normalized_df, normalize_seconds = future.result()
+                    df = self.split_account_tickers(normalized_df)
+                    
+                    allocate_started = time.perf_counter()
+                    with contextlib.redirect_stdout(output):
+                        unresolved = self.process_asset_allocation(
+                            df, datetime.strptime(date_str, '%Y-%m-%d'), batch_size=batch_size, staged=True
+                        )
+                        self.allocator.publish_staged()
+                    allocate_seconds = time.perf_counter() - allocate_started
+                except Exception as e:
+                    print(f"[{i}/{len(futures)}] {date_str}: FAILED - {e}")
+                    self._print_backfill_errors(output.getvalue(), failed=True)
+                    continue
+                
+                results[date_str] = len(df)
+                rate = len(df) / allocate_seconds if allocate_seconds > 0 else 0.0
+                print(f"[{i}/{len(futures)}] {date_str}: {len(df)} positions, {len(unresolved)} unresolved, "
+                      f"normalize {normalize_seconds:.2f}s, allocate {allocate_seconds:.2f}s ({rate:,.0f} positions/s)")
+                if unresolved:
+                    names = sorted({f"{miss['ticker']} ({miss['held_at']})" for miss in unresolved})
+                    print(f"    Unresolved: {', '.join(names)}")
+                self._print_backfill_errors(output.getvalue())
+        
+        elapsed = time.perf_counter() - started
+        total = sum(results.values())
+        print("=" * 60)
+        print(f"Backfilled {len(results)}/{len(snapshots)} dates, {total} positions in {elapsed:.2f}s "
+              f"({len(results) / elapsed if elapsed > 0 else 0.0:.2f} dates/s)")
+        print("=" * 60)
+        return results
+    
+    @staticmethod
+    def _print_backfill_errors(output: str, failed: bool = False):
+        """Print the row errors (and, for a failed date, validation problems) from captured allocation output"""
+        lines = [line.strip() for line in output.splitlines()]
+        errors = [line for line in lines if line.startswith(('Error ', 'Error:')) and line != 'Error details:']
+        if failed:
+            # "Error details" repeats row errors and unresolved tickers; the rest are validation problems
+            errors += [line for line in lines
+                       if line.startswith('- ') and not line.startswith(('- Asset not found', '- Row '))]
+        for line in errors:
+            print(f"    {line}")
+    
+    def attribution_report(self, as_of_date: datetime, period: str = '1m', top: int = 10):
+        """
+        Print how each account, allocation type, sector, interest type and holding
+        contributed to the portfolio return over a period
+        
+        Args:
+            as_of_date: Holdings date (the latest one on or before it is used)
+            period: Gain period (1w, 2w, 1m, 3m, 6m, 1y, or a horizon stored with --horizons)
+            top: Number of best and worst holdings to list
+        
+        Returns:
+            Attribution DataFrames by dimension, see AttributionEngine.attribute()
+        """
+        results = AttributionEngine(self.db).attribute(as_of_date, period)
+        AttributionEngine.print_report(results, top=top)
+        return results
+    
+    def returns_report(self, start: datetime = None, end: datetime = None):
+        """
+        Print time-weighted and money-weighted returns per account and for the portfolio
+        
+        Args:
+            start: First snapshot date to include (default: earliest stored)
+            end: Last snapshot date to include (default: latest stored)
+        
+        Returns:
+            Returns DataFrame, see ReturnsEngine.returns()
+        """
+        engine = ReturnsEngine(self.db, self.price_cache)
+        results = engine.returns(start, end)
+        engine.print_report(results)
+        return results
+    
     def show_unique_dates(self, after_date: datetime = None):
         """
         Show unique dates for which there is data, optionally filtered after a given date
@@ -1481,6 +1598,27 @@ class AssetProcessor:
         print(f"\n{'='*60}")
 
 
+def _normalize_snapshot(excel_file: str, files: dict):
+    """
+    Process pool worker: normalize one dated snapshot without writing allaccounts.csv
+    
+    Args:
+        excel_file: Excel file path, used to build a processor in the worker
+        files: Source paths for the date as returned by find_backup_snapshots
+        
+    Returns:
+        Tuple of (account_ticker/amount DataFrame, seconds taken)
+    """
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if all(name in files for name in PARSERS):
+            normalized_df, _ = AssetProcessor(excel_file).normalize_full_view(
+                source_files={name: files[name] for name in PARSERS}, write_csv=False)
+        else:
+            normalized_df = pd.read_csv(files['allaccounts'])
+    return normalized_df, time.perf_counter() - started
+
+
 def main():
     """Main entry point"""
     import argparse
@@ -1498,14 +1636,40 @@ def main():
                        help='Calculate gains after allocation (not default)')
     parser.add_argument('--gains-only', action='store_true',
                        help='Only calculate gains, skip allocation')
+    parser.add_argument('--horizons', nargs='+', choices=list(HORIZONS), metavar='HORIZON',
+                       help='Also store returns for these horizons in assetgainhorizon '
+                            f'({", ".join(HORIZONS)})')
+    parser.add_argument('--price-source', metavar='DIR_OR_URL',
+                       help='Fetch gain prices only from a fixture directory or fixture_server.py URL')
+    parser.add_argument('--repair-prices', nargs='+', metavar='TICKER',
+                       help='Drop and refetch the cached price history of these tickers (up to --date)')
     parser.add_argument('--delete-only', action='store_true',
                        help='Only delete data, skip allocation and gains')
     parser.add_argument('--process', action='store_true',
                        help='Run main asset allocation workflow (default if no other mode specified)')
+    parser.add_argument('--bulk', action='store_true',
+                       help='Write allocation rows with batched multi-row inserts in one transaction')
+    parser.add_argument('--batch-size', type=int, default=500,
+                       help='Rows per multi-row INSERT when using --bulk (default: 500)')
+    # --staged replaces the whole date while --diff patches it in place
+    replace_mode = parser.add_mutually_exclusive_group()
+    replace_mode.add_argument('--staged', action='store_true',
+                       help='Load the date into staging tables with the bulk path, validate totals, '
+                            'then atomically replace the date\'s holdings')
+    replace_mode.add_argument('--diff', action='store_true',
+                       help='Re-allocate incrementally: only insert, update or delete positions that '
+                            'changed since the last run for the date')
+    parser.add_argument('--backfill', nargs=2, metavar=('FROM', 'TO'),
+                       help='Reprocess dated snapshots in backup/ between FROM and TO (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int,
+                       help='Processes used to normalize snapshots with --backfill (default: CPU count)')
     parser.add_argument('--normalize', action='store_true',
-                       help='Normalize full view data and aggregate by account')
+                       help='Normalize full view data and aggregate by account '
+                            '(with --process, allocate the result in the same run)')
     parser.add_argument('--normalize-sheet', default='fidfullview',
                        help='Sheet name for normalize operation (default: fidfullview)')
+    parser.add_argument('--force', action='store_true',
+                       help='Normalize even when the broker exports are unchanged since the last run')
     parser.add_argument('--output', '-o',
                        help='Output Excel file for normalize results')
     parser.add_argument('--refresh-dataconn', action='store_true',
@@ -1522,6 +1686,13 @@ def main():
                        help='Date to compare for wkdates table and assetref N3 (YYYY-MM-DD)')
     parser.add_argument('--fix-references', action='store_true',
                        help='Fix external workbook references in formulas')
+    parser.add_argument('--attribution', action='store_true',
+                       help='Report return contributions by account, allocation type, sector, interest type and holding')
+    parser.add_argument('--period', default='1m', choices=list(HORIZONS),
+                       help='Gain period for --attribution (default: 1m)')
+    parser.add_argument('--returns', nargs='*', metavar='DATE',
+                       help='Report time- and money-weighted returns per account between two snapshot dates '
+                            '(YYYY-MM-DD; default: all stored snapshots)')
     parser.add_argument('--show-dates', action='store_true',
                        help='Show unique dates for which there is data in the database')
     parser.add_argument('--after-date',
@@ -1567,21 +1738,42 @@ def main():
     
     # Create processor
     processor = AssetProcessor(args.file)
+    if args.horizons:
+        processor.gain_calculator.horizons = tuple(args.horizons)
+    if args.price_source:
+        processor.gain_calculator.providers = processor.price_providers(args.price_source,
+                                                                        processor.gain_calculator.fetcher)
+        # Keep fixture prices out of the real price cache
+        processor.gain_calculator.price_cache = None
     
     # Execute based on flags
     if args.show_dates:
         # Show unique dates with optional filtering
         processor.show_unique_dates(after_date=after_date)
-    elif args.normalize:
-        # Update Assetalloc dates
-        processor.update_assetalloc_dates(
+    elif args.normalize and args.process:
+        # Normalize and allocate in one run, handing the positions over in memory
+        processor.normalize_and_process(
+            as_of_date,
             prevdate=datetocompare.strftime('%Y-%m-%d') if datetocompare else None,
-            currdate=as_of_date.strftime('%Y-%m-%d') if as_of_date else None
+            currdate=as_of_date.strftime('%Y-%m-%d') if as_of_date else None,
+            output_file=args.output,
+            force=args.force,
+            sheet_name=args.sheet,
+            delete_existing=not args.no_delete,
+            calculate_gains=args.with_gains,
+            bulk=args.bulk,
+            batch_size=args.batch_size,
+            staged=args.staged,
+            diff=args.diff
         )
-        # Run normalize full view
-        processor.normalize_full_view(
+    elif args.normalize:
+        # Update Assetalloc dates and normalize, unless the exports are unchanged since the last run
+        processor.run_normalize(
+            prevdate=datetocompare.strftime('%Y-%m-%d') if datetocompare else None,
+            currdate=as_of_date.strftime('%Y-%m-%d') if as_of_date else None,
             sheet_name=args.normalize_sheet,
-            output_file=args.output
+            output_file=args.output,
+            force=args.force
         )
     elif args.refresh_dataconn:
         # Refresh dataconn sheet
@@ -1596,13 +1788,35 @@ def main():
     elif args.fix_references:
         # Fix external workbook references
         processor.fix_external_references()
+    elif args.attribution:
+        processor.attribution_report(as_of_date, args.period)
+    elif args.returns is not None:
+        if len(args.returns) > 2:
+            print("Error: --returns takes at most two dates (FROM TO)")
+            sys.exit(1)
+        try:
+            start_date, end_date = ([datetime.strptime(value, '%Y-%m-%d') for value in args.returns] + [None, None])[:2]
+        except ValueError:
+            print("Error: Invalid returns date format. Use YYYY-MM-DD")
+            sys.exit(1)
+        processor.returns_report(start_date, end_date)
+    elif args.backfill:
+        try:
+            from_date, to_date = (datetime.strptime(value, '%Y-%m-%d') for value in args.backfill)
+        except ValueError:
+            print("Error: Invalid backfill date format. Use YYYY-MM-DD")
+            sys.exit(1)
+        processor.backfill(from_date, to_date, workers=args.workers, batch_size=args.batch_size)
+    elif args.repair_prices:
+        processor.gain_calculator.repair_prices(args.repair_prices, as_of_date)
     elif args.delete_only:
         processor.delete_existing_data(as_of_date)
     elif args.gains_only:
         processor.calculate_gains(as_of_date)
     elif args.process or not any([args.normalize, args.refresh_dataconn, 
                                    args.compare_dates, args.fix_references, args.delete_only, 
-                                   args.gains_only, args.show_dates]):
+                                   args.gains_only, args.show_dates, args.backfill, args.repair_prices,
+                                   args.attribution, args.returns is not None]):
         # Update Assetalloc dates
         processor.update_assetalloc_dates(
             prevdate=datetocompare.strftime('%Y-%m-%d') if datetocompare else None,
@@ -1613,8 +1827,15 @@ def main():
             as_of_date=as_of_date,
             sheet_name=args.sheet,
             delete_existing=not args.no_delete,
-            calculate_gains=args.with_gains
+            calculate_gains=args.with_gains,
+            bulk=args.bulk,
+            batch_size=args.batch_size,
+            staged=args.staged,
+            diff=args.diff
         )
+    
+    # Close pooled connections and report how many were opened
+    processor.db.close_all()
 
 
 if __name__ == '__main__':
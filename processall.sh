@@ -84,9 +84,7 @@ ensure_assets_container_running
 wait_for_mysql_ready
 
 if [ "$action" = "main" ]; then
-    python process_assets.py --delete-only --date "$currdate"
-    python process_assets.py --normalize --date "$currdate" --datetocompare "$prevdate"
-    python process_assets.py --process --date "$currdate" --datetocompare "$prevdate"
+    python process_assets.py --normalize --process --staged --date "$currdate" --datetocompare "$prevdate"
     python process_assets.py --refresh-dataconn --currdate "$currdate" --datetocompare "$prevdate"
     python process_assets.py --compare-dates --currdate "$currdate" --datetocompare "$prevdate" --threshold "$threshold" --show-all
 elif [ "$action" = "compare" ]; then
@@ -0,0 +1,224 @@
+"""
+Returns Engine
+Time-weighted and money-weighted returns per account and for the whole portfolio
+from the weekly assetinv snapshots, with contributions and withdrawals inferred
+from the cached daily closes
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from gains_matrix import asof_prices, price_matrix
+
+TOTAL = 'Total'
+
+RESULT_COLUMNS = ['start', 'end', 'snapshots', 'start_value', 'end_value', 'net_flows',
+                  'twr', 'twr_annualized', 'irr']
+
+
+def infer_flows(amounts: np.ndarray, growth: np.ndarray) -> np.ndarray:
+    """
+    Flows between consecutive snapshots that price moves do not explain
+
+    Args:
+        amounts: snapshots x positions holdings
+        growth: (snapshots - 1) x positions price ratio of each position over each step
+            (1 where no price is known)
+
+    Returns:
+        (snapshots - 1) x positions flows, counted at the end of each step; positive
+        values are money added
+    """
+    return amounts[1:] - amounts[:-1] * growth
+
+
+def time_weighted(values: np.ndarray, flows: np.ndarray) -> np.ndarray:
+    """
+    Cumulative time-weighted return per column
+
+    Args:
+        values: snapshots x accounts values
+        flows: (snapshots - 1) x accounts flows at the end of each step
+
+    Returns:
+        Fraction per account; steps starting from a zero value are skipped
+    """
+    start = values[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steps = np.where(start > 0, (values[1:] - flows) / start, 1.0)
+    return np.prod(steps, axis=0) - 1
+
+
+def money_weighted(values: np.ndarray, flows: np.ndarray, years: np.ndarray,
+                   iterations: int = 100, tolerance: float = 1e-9) -> np.ndarray:
+    """
+    Internal rate of return per column, solved for all accounts at once with Newton's method
+
+    Args:
+        values: snapshots x accounts values
+        flows: (snapshots - 1) x accounts flows at the end of each step
+        years: Years from the first snapshot to each snapshot
+
+    Returns:
+        Annual rate per account as a fraction; NaN where the solver does not converge
+    """
+    # Investor cash flows: the starting value and each flow go in, the end value comes out
+    cash = np.vstack([-values[:1], -flows])
+    cash[-1] += values[-1]
+    cash = cash.T
+    scale = np.abs(cash).sum(axis=1)
+    scale[scale == 0] = 1.0
+
+    rate = np.zeros(cash.shape[0])
+    converged = np.zeros(cash.shape[0], dtype=bool)
+    for _ in range(iterations):
+        discount = np.power(1 + rate[:, None], -years[None, :])
+        npv = (cash * discount).sum(axis=1)
+        slope = (-years[None, :] * cash * discount).sum(axis=1) / (1 + rate)
+        converged = np.abs(npv) <= tolerance * scale
+        if converged.all():
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(converged | (slope == 0), 0.0, npv / slope)
+        rate = np.clip(rate - np.nan_to_num(step), -0.99, 100.0)
+    return np.where(converged, rate, np.nan)
+
+
+class ReturnsEngine:
+    """
+    Account and portfolio returns over any range of stored snapshots
+
+    Between consecutive snapshots each position is expected to grow with its ticker's
+    close in the price cache; the rest of the change is a flow. Tickers without cached
+    prices (cash, money market, unpriced funds) are treated as flat, so all of their
+    changes count as flows.
+    """
+
+    def __init__(self, db, price_cache=None):
+        self.db = db
+        self.price_cache = price_cache
+
+    def load_history(self, start=None, end=None) -> pd.DataFrame:
+        """Every holding between start and end (inclusive) with one query: asofdate, heldat, ticker, amount"""
+        query = """
+            SELECT ai.asofdate, ai.heldat, a.ticker, ai.amount
+            FROM assetinv ai
+            JOIN asset a ON a.assetid = ai.assetid
+            WHERE ai.asofdate BETWEEN %s AND %s
+            ORDER BY ai.asofdate
+        """
+        first = start.strftime('%Y-%m-%d') if start else '1900-01-01'
+        last = end.strftime('%Y-%m-%d') if end else '9999-12-31'
+        with self.db.session():
+            rows = self.db.execute_query(query, (first, last))
+        history = pd.DataFrame(rows, columns=['asofdate', 'heldat', 'ticker', 'amount'])
+        history['asofdate'] = pd.to_datetime(history['asofdate'])
+        history['amount'] = history['amount'].astype(np.float64)
+        return history
+
+    def growth(self, tickers: list, dates: pd.DatetimeIndex) -> np.ndarray:
+        """(dates - 1) x tickers price ratios between consecutive dates; 1 where either close is unknown"""
+        ratios = np.ones((len(dates) - 1, len(tickers)))
+        if self.price_cache is None or len(dates) < 2:
+            return ratios
+
+        # Start a week early so the first snapshot can use the last close before it
+        histories = self.price_cache.histories(tickers, dates[0] - pd.Timedelta(days=7), dates[-1])
+        priced = [ticker for ticker in tickers if ticker in histories]
+        if not priced:
+            return ratios
+
+        prices = asof_prices(price_matrix({ticker: histories[ticker] for ticker in priced}), list(dates))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            steps = prices[1:] / prices[:-1]
+        steps = np.where(np.isfinite(steps) & (steps > 0), steps, 1.0)
+        columns = [tickers.index(ticker) for ticker in priced]
+        ratios[:, columns] = steps
+        return ratios
+
+    def returns(self, start=None, end=None, history: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """
+        Time- and money-weighted returns for each account and the whole portfolio
+
+        Args:
+            start: First snapshot date to include (default: earliest stored)
+            end: Last snapshot date to include (default: latest stored)
+            history: Output of load_history, to reuse one load for several ranges
+
+        Returns:
+            DataFrame indexed by account (plus a 'Total' row) with start, end, snapshots,
+            start_value, end_value, net_flows, twr (cumulative %), twr_annualized (% when
+            the range is at least a year, else NaN) and irr (annual %)
+        """
+        if history is None:
+            history = self.load_history(start, end)
+        else:
+            mask = np.ones(len(history), dtype=bool)
+            if start is not None:
+                mask &= history['asofdate'] >= pd.Timestamp(start).normalize()
+            if end is not None:
+                mask &= history['asofdate'] <= pd.Timestamp(end).normalize()
+            history = history[mask]
+        if history['asofdate'].nunique() < 2:
+            raise Exception("At least two snapshots are needed to compute returns")
+
+        # snapshots x positions, where a position is an (account, ticker) pair
+        positions = history.pivot_table(index='asofdate', columns=['heldat', 'ticker'], values='amount',
+                                        aggfunc='sum', fill_value=0.0).sort_index()
+        dates = positions.index
+        amounts = positions.to_numpy(dtype=np.float64)
+        accounts = positions.columns.get_level_values('heldat')
+        position_tickers = positions.columns.get_level_values('ticker')
+
+        tickers = sorted(set(position_tickers))
+        ratios = self.growth(tickers, dates)
+        ticker_index = pd.Index(tickers).get_indexer(position_tickers)
+        flows = infer_flows(amounts, ratios[:, ticker_index])
+
+        # Sum positions into accounts with a 0/1 membership matrix, plus a column for the total
+        names = sorted(set(accounts))
+        membership = (np.asarray(accounts)[:, None] == np.array(names, dtype=object)[None, :]).astype(np.float64)
+        membership = np.hstack([membership, np.ones((len(accounts), 1))])
+        values = amounts @ membership
+        account_flows = flows @ membership
+
+        years = ((dates - dates[0]) / pd.Timedelta(days=1)).to_numpy(dtype=np.float64) / 365.25
+        twr = time_weighted(values, account_flows)
+        span = years[-1]
+        with np.errstate(invalid='ignore'):
+            twr_annualized = np.power(1 + twr, 1 / span) - 1 if span >= 1 else np.full(len(twr), np.nan)
+        irr = money_weighted(values, account_flows, years)
+
+        return pd.DataFrame({
+            'start': dates[0].strftime('%Y-%m-%d'),
+            'end': dates[-1].strftime('%Y-%m-%d'),
+            'snapshots': len(dates),
+            'start_value': values[0],
+            'end_value': values[-1],
+            'net_flows': account_flows.sum(axis=0),
+            'twr': twr * 100,
+            'twr_annualized': twr_annualized * 100,
+            'irr': irr * 100,
+        }, index=pd.Index(names + [TOTAL], name='account'), columns=RESULT_COLUMNS)
+
+    @staticmethod
+    def print_report(results: pd.DataFrame):
+        """Print the returns table"""
+        first = results.iloc[0]
+        print(f"\n{'='*60}")
+        print(f"Account Returns {first['start']} to {first['end']} ({first['snapshots']} snapshots)")
+        print(f"{'='*60}")
+        print(f"{'Account':<12} {'Start':>14} {'End':>14} {'Net Flows':>14} {'TWR':>9} {'TWR/yr':>9} {'IRR':>9}")
+        print(f"{'-'*85}")
+
+        def percent(value):
+            return f"{value:>+8.2f}%" if np.isfinite(value) else f"{'n/a':>9}"
+
+        for account, row in results.iterrows():
+            if account == TOTAL:
+                print(f"{'-'*85}")
+            print(f"{str(account)[:12]:<12} {row['start_value']:>14,.2f} {row['end_value']:>14,.2f} "
+                  f"{row['net_flows']:>14,.2f} {percent(row['twr'])} {percent(row['twr_annualized'])} "
+                  f"{percent(row['irr'])}")
@@ -0,0 +1,83 @@
+"""
+Trading Calendar
+Finds the previous trading day with a bisect over an in-memory, sorted array of
+trading days built from the holiday table once per run
+"""
+
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from typing import Iterable
+
+
+def _as_date(value) -> date:
+    """Accept date, datetime or 'YYYY-MM-DD' values"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+class TradingCalendar:
+    """
+    Weekdays minus holidays, stored as sorted date ordinals
+
+    The array covers whole years and grows on demand, so lookups far outside the
+    loaded range still work. Results keep the time of day of datetime arguments.
+    """
+
+    def __init__(self, holidays: Iterable = ()):
+        self.holidays = {_as_date(holiday) for holiday in holidays}
+        self.days = []  # Sorted ordinals of trading days
+        self.first_year = None
+        self.last_year = None
+
+    @classmethod
+    def load(cls, db) -> 'TradingCalendar':
+        """Build a calendar from every row of the holiday table"""
+        rows = db.execute_query("SELECT holiday_date FROM holiday")
+        calendar = cls(row['holiday_date'] for row in rows)
+        print(f"Loaded trading calendar: {len(calendar.holidays)} holidays")
+        return calendar
+
+    def _cover(self, day: date):
+        """Extend the trading-day array to include the year of day (and the year before)"""
+        first, last = day.year - 1, day.year
+        if self.first_year is not None:
+            if self.first_year <= first and last <= self.last_year:
+                return
+            first, last = min(first, self.first_year), max(last, self.last_year)
+
+        start = date(first, 1, 1).toordinal()
+        end = date(last, 12, 31).toordinal()
+        self.days = [
+            ordinal for ordinal in range(start, end + 1)
+            if ordinal % 7 not in (0, 6) and date.fromordinal(ordinal) not in self.holidays
+        ]
+        self.first_year, self.last_year = first, last
+
+    @staticmethod
+    def _shift(value, day: date):
+        """Return day in the type of value (datetimes keep their time of day)"""
+        if isinstance(value, datetime):
+            return value + timedelta(days=day.toordinal() - value.date().toordinal())
+        return day
+
+    def previous_trading_day(self, value):
+        """Latest trading day on or before value"""
+        day = _as_date(value)
+        self._cover(day)
+        i = bisect_right(self.days, day.toordinal()) - 1
+        while i < 0:
+            # Before the covered range: extend backwards a year at a time
+            self._cover(date(self.first_year, 1, 1))
+            i = bisect_right(self.days, day.toordinal()) - 1
+        return self._shift(value, date.fromordinal(self.days[i]))
+
+    def weeks_back(self, value, weeks: int):
+        """Trading day on or before the date that many weeks before value"""
+        return self.previous_trading_day(value - timedelta(weeks=weeks))
+
+    def days_back(self, value, days: int):
+        """Trading day on or before the date that many calendar days before value"""
+        return self.previous_trading_day(value - timedelta(days=days))